@@ -1,10 +1,76 @@
 from __future__ import annotations
 
 import asyncio
+import logging
 
 from homeassistant import config_entries, core
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers.event import async_track_time_change
 
-from .const import DOMAIN
+from .const import (
+    CONF_COMPILED,
+    CONF_FEED,
+    CONF_ORIGIN,
+    CONF_PRUNED,
+    CONF_SOURCE,
+    CONF_STATION,
+    DEFAULT_COMPILED,
+    DEFAULT_FEED,
+    DEFAULT_PRUNED,
+    DOMAIN,
+)
+from .fetch_api import (
+    Feed,
+    async_load_feed,
+    cancel_imports,
+    get_feed,
+    maintain_database,
+    set_compiled_timetable,
+    set_pruned_stops,
+    set_timetable_source,
+    start_gtfs_fetch,
+)
+from .services import async_setup_services
+from .snapshot import async_load_snapshot
+from .websocket import async_setup_websocket_api
+
+_LOGGER = logging.getLogger(__name__)
+
+PLATFORMS = ["sensor", "device_tracker"]
+
+
+def _get_entry_config(entry: config_entries.ConfigEntry):
+    if CONF_STATION in entry.options or CONF_ORIGIN in entry.options:
+        return entry.options
+    return entry.data
+
+
+def _update_feed_settings(hass: core.HomeAssistant, feed: Feed):
+    """Apply database settings requested by any entry of the feed."""
+    configs = [
+        _get_entry_config(entry)
+        for entry in hass.config_entries.async_entries(DOMAIN)
+        if get_feed(entry.data.get(CONF_FEED, DEFAULT_FEED)) == feed
+    ]
+    if any(config.get(CONF_PRUNED, DEFAULT_PRUNED) for config in configs):
+        # Whole trips are kept, so the origin of a connection covers its
+        # destination too
+        set_pruned_stops(
+            feed,
+            {config.get(CONF_STATION) or config[CONF_ORIGIN] for config in configs},
+        )
+    else:
+        set_pruned_stops(feed, None)
+    set_compiled_timetable(
+        feed, any(config.get(CONF_COMPILED, DEFAULT_COMPILED) for config in configs)
+    )
+    set_timetable_source(
+        feed,
+        next(
+            (config[CONF_SOURCE] for config in configs if config.get(CONF_SOURCE)),
+            None,
+        ),
+    )
 
 
 async def async_setup_entry(
@@ -14,8 +80,14 @@ async def async_setup_entry(
     hass.data.setdefault(DOMAIN, {})
     hass.data[DOMAIN][entry.entry_id] = entry.data
 
-    # Forward the setup to the sensor platform.
-    await hass.config_entries.async_forward_entry_setups(entry, ["sensor"])
+    # Rebuilds the timetable if this entry adds a stop to a pruned database
+    feed = get_feed(entry.data.get(CONF_FEED, DEFAULT_FEED))
+    _update_feed_settings(hass, feed)
+    await async_load_feed(feed)
+    start_gtfs_fetch(feed)
+
+    # Forward the setup to the sensor and device tracker platforms.
+    await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
     entry.async_on_unload(entry.add_update_listener(options_update_listener))
     return True
 
@@ -29,6 +101,31 @@ async def options_update_listener(
 
 async def async_setup(hass: core.HomeAssistant, config: dict) -> bool:
     hass.data.setdefault(DOMAIN, {})
+
+    @core.callback
+    def _async_cancel_imports(event: core.Event) -> None:
+        cancel_imports()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _async_cancel_imports)
+
+    async def _async_maintain_databases(now) -> None:
+        feeds = {
+            get_feed(entry.data.get(CONF_FEED, DEFAULT_FEED))
+            for entry in hass.config_entries.async_entries(DOMAIN)
+        }
+        for feed in feeds:
+            try:
+                await maintain_database(feed)
+            except Exception:  # Other feeds are still maintained
+                _LOGGER.exception("Failed to maintain databases of %s", feed.feed_id)
+
+    # Databases are maintained at night when there are few departures
+    async_track_time_change(
+        hass, _async_maintain_databases, hour=3, minute=30, second=0
+    )
+    async_setup_services(hass)
+    async_setup_websocket_api(hass)
+    await async_load_snapshot(hass)
     return True
 
 
@@ -38,7 +135,10 @@ async def async_unload_entry(
     """Unload a config entry."""
     unload_ok = all(
         await asyncio.gather(
-            *[hass.config_entries.async_forward_entry_unload(entry, "sensor")]
+            *[
+                hass.config_entries.async_forward_entry_unload(entry, platform)
+                for platform in PLATFORMS
+            ]
         )
     )
 
@@ -0,0 +1,225 @@
+"""Builds and installs prebuilt timetable bundles.
+
+A bundle is a zip of a ready-made timetable database, and optionally a
+compiled timetable, with a manifest describing the versions and checksums of
+the files. Bundles are built from GTFS data with the import code of the
+integration, so that slow hosts can skip parsing GTFS data themselves.
+"""
+
+import argparse
+from concurrent import futures
+from datetime import UTC, datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import urllib.request
+import zipfile
+
+from .importer import SCHEMA_VERSION, compact_database, import_csv_files
+from .timetable import TIMETABLE_FILENAME, TIMETABLE_VERSION
+
+_LOGGER = logging.getLogger(__name__)
+
+# Bumped whenever the bundle layout changes
+BUNDLE_FORMAT = 1
+MANIFEST_FILENAME = "manifest.json"
+DATABASE_FILENAME = "database.db"
+_BUNDLE_FILES = (DATABASE_FILENAME, TIMETABLE_FILENAME)
+_READ_SIZE = 1024 * 1024
+
+
+def _hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(_READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_bundle(gtfs_path, output_path, compile_timetable, executor):
+    """Import a GTFS zip and package the result as a bundle.
+
+    Args:
+        gtfs_path (str): Path of the GTFS zip.
+        output_path (str): Path of the bundle to write.
+        compile_timetable (bool): Whether to include a compiled timetable.
+        executor (concurrent.futures.Executor): Executor for parsing chunks.
+
+    Returns:
+        dict: The manifest of the bundle.
+
+    """
+    version = datetime.now(UTC).strftime("%Y%m%dT%H%M%SZ")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = tmp_dir + os.sep
+        with zipfile.ZipFile(gtfs_path) as gtfs:
+            gtfs.extractall(path)
+        meta = import_csv_files(path, None, compile_timetable, executor)
+        # Installed databases are not compacted again on the device
+        compact_database(path)
+        conn = sqlite3.connect(path + DATABASE_FILENAME)
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('bundle', ?)",
+                (version,),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        files = [DATABASE_FILENAME]
+        if "compiled_timetable" in meta:
+            files.append(TIMETABLE_FILENAME)
+        manifest = {
+            "format": BUNDLE_FORMAT,
+            "version": version,
+            "schema_version": SCHEMA_VERSION,
+            "timetable_version": TIMETABLE_VERSION if len(files) > 1 else None,
+            "feed_version": meta.get("feed_version"),
+            "files": {
+                name: {
+                    "size": os.path.getsize(path + name),
+                    "sha256": _hash_file(path + name),
+                }
+                for name in files
+            },
+        }
+        with zipfile.ZipFile(
+            output_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9
+        ) as bundle:
+            bundle.writestr(MANIFEST_FILENAME, json.dumps(manifest, indent=2))
+            for name in files:
+                bundle.write(path + name, name)
+    return manifest
+
+
+def is_bundle(file_path):
+    """Check whether a zip file is a bundle rather than GTFS data.
+
+    Args:
+        file_path (str): Path of the zip file.
+
+    Returns:
+        bool: True if the file is a bundle.
+
+    """
+    if not zipfile.is_zipfile(file_path):
+        return False
+    with zipfile.ZipFile(file_path) as zip_file:
+        return MANIFEST_FILENAME in zip_file.namelist()
+
+
+def _check_manifest(manifest):
+    if manifest.get("format") != BUNDLE_FORMAT:
+        raise ValueError(f"Unsupported bundle format {manifest.get('format')}")
+    if manifest.get("schema_version") != SCHEMA_VERSION:
+        raise ValueError(
+            f"Bundle is built for database schema {manifest.get('schema_version')}, "
+            f"expected {SCHEMA_VERSION}"
+        )
+    files = manifest.get("files", {})
+    if DATABASE_FILENAME not in files or not set(files).issubset(_BUNDLE_FILES):
+        raise ValueError(f"Unexpected files in bundle: {', '.join(files)}")
+    if (
+        TIMETABLE_FILENAME in files
+        and manifest.get("timetable_version") != TIMETABLE_VERSION
+    ):
+        raise ValueError(
+            f"Bundle has compiled timetable version {manifest.get('timetable_version')}, "
+            f"expected {TIMETABLE_VERSION}"
+        )
+
+
+def install_bundle(file_path, path):
+    """Verify a bundle and replace the timetable files with its contents.
+
+    Every file is extracted next to its destination and checked against the
+    manifest before any file is replaced.
+
+    Args:
+        file_path (str): Path of the bundle.
+        path (str): Directory of the timetable files.
+
+    Returns:
+        dict: The manifest of the installed bundle.
+
+    Raises:
+        ValueError: If the bundle is not compatible or is damaged.
+
+    """
+    with zipfile.ZipFile(file_path) as bundle:
+        manifest = json.loads(bundle.read(MANIFEST_FILENAME))
+        _check_manifest(manifest)
+        files = manifest["files"]
+        try:
+            for name, info in files.items():
+                digest = hashlib.sha256()
+                with bundle.open(name) as src, open(path + name + ".tmp", "wb") as dst:
+                    while chunk := src.read(_READ_SIZE):
+                        digest.update(chunk)
+                        dst.write(chunk)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                if digest.hexdigest() != info["sha256"]:
+                    raise ValueError(f"Checksum of {name} in bundle does not match")
+        except BaseException:
+            for name in files:
+                if os.path.isfile(path + name + ".tmp"):
+                    os.remove(path + name + ".tmp")
+            raise
+
+    # The database is replaced last, since its metadata describes the other files
+    for name in sorted(files, key=lambda name: name == DATABASE_FILENAME):
+        os.replace(path + name + ".tmp", path + name)
+    if TIMETABLE_FILENAME not in files and os.path.isfile(path + TIMETABLE_FILENAME):
+        os.remove(path + TIMETABLE_FILENAME)
+    return manifest
+
+
+def main(argv=None):
+    """Build a bundle from the command line."""
+    arg_parser = argparse.ArgumentParser(
+        description="Build a prebuilt timetable bundle from a GTFS zip."
+    )
+    arg_parser.add_argument("gtfs", help="path or URL of the GTFS zip")
+    arg_parser.add_argument(
+        "-o",
+        "--output",
+        help="path of the bundle, named after its version by default",
+    )
+    arg_parser.add_argument(
+        "--no-compile",
+        action="store_true",
+        help="leave out the compiled timetable",
+    )
+    arg_parser.add_argument(
+        "-j", "--jobs", type=int, help="number of parsing processes"
+    )
+    args = arg_parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gtfs_path = args.gtfs
+        if gtfs_path.startswith(("http://", "https://")):
+            _LOGGER.info("Downloading %s", gtfs_path)
+            gtfs_path = os.path.join(tmp_dir, "gtfs.zip")
+            urllib.request.urlretrieve(args.gtfs, gtfs_path)
+        bundle_path = os.path.join(tmp_dir, "bundle.zip")
+        with futures.ProcessPoolExecutor(args.jobs) as executor:
+            manifest = build_bundle(
+                gtfs_path, bundle_path, not args.no_compile, executor
+            )
+        output_path = args.output or f"nysse_bundle_{manifest['version']}.zip"
+        shutil.move(bundle_path, output_path)
+
+    _LOGGER.info(
+        "Wrote %s (%s bytes), feed version %s",
+        output_path,
+        os.path.getsize(output_path),
+        manifest["feed_version"],
+    )
+    return 0
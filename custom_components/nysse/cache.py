@@ -0,0 +1,66 @@
+"""Request coalescing for identical concurrent calls."""
+
+import asyncio
+import time
+
+# Completed results are kept at most this many seconds by default
+DEFAULT_TTL = 5
+# Expired results are pruned once this many results are stored
+_PRUNE_SIZE = 256
+
+
+class SingleFlight:
+    """Shares one in-flight call between callers using the same key.
+
+    Results are also kept for a short time, so bursts of identical calls are
+    served from memory. Lists are copied for each caller so that they can be
+    modified safely.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL) -> None:
+        """Initialize the coalescer."""
+        self._ttl = ttl
+        self._in_flight: dict[object, asyncio.Future] = {}
+        self._results: dict[object, tuple[object, float]] = {}
+
+    def _store_result(self, key, future: asyncio.Future):
+        self._in_flight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        now = time.monotonic()
+        if len(self._results) >= _PRUNE_SIZE:
+            self._results = {
+                k: v for k, v in self._results.items() if now - v[1] < self._ttl
+            }
+        self._results[key] = (future.result(), now)
+
+    def clear(self):
+        """Forget stored results, e.g. after the underlying data changed."""
+        self._results.clear()
+
+    async def run(self, key, func, *args):
+        """Call func(*args) unless an identical call is running or recent.
+
+        Args:
+            key: Hashable key identifying identical calls.
+            func: Coroutine function to call.
+            *args: Arguments for func.
+
+        Returns:
+            The result of the shared call.
+
+        """
+        result = self._results.get(key)
+        if result is not None and time.monotonic() - result[1] < self._ttl:
+            value = result[0]
+        else:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = asyncio.ensure_future(func(*args))
+                self._in_flight[key] = future
+                future.add_done_callback(lambda future: self._store_result(key, future))
+            # A cancelled caller must not cancel the call shared with others
+            value = await asyncio.shield(future)
+        if isinstance(value, list):
+            return list(value)
+        return value
@@ -1,3 +1,4 @@
+import os
 from typing import Any, Optional
 
 import voluptuous as vol
@@ -6,17 +7,54 @@ from homeassistant import config_entries
 from homeassistant.core import callback
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.selector import selector
+import homeassistant.util.dt as dt_util
 
 from .const import (
+    CONF_COMPILED,
+    CONF_DESTINATION,
+    CONF_FEED,
+    CONF_HISTORY,
     CONF_LINES,
     CONF_MAX,
+    CONF_ORIGIN,
+    CONF_PRUNED,
+    CONF_SOURCE,
     CONF_STATION,
     CONF_TIMELIMIT,
+    CONF_TRIP_STOPS,
+    CONF_VEHICLES,
+    DEFAULT_COMPILED,
+    DEFAULT_FEED,
+    DEFAULT_HISTORY,
     DEFAULT_MAX,
+    DEFAULT_PRUNED,
+    DEFAULT_SOURCE,
     DEFAULT_TIMELIMIT,
+    DEFAULT_TRIP_STOPS,
+    DEFAULT_VEHICLES,
     DOMAIN,
+    FEEDS,
 )
-from .fetch_api import get_route_ids, get_stops
+from .fetch_api import (
+    get_connections,
+    get_feed,
+    get_nearest_stops,
+    get_route_ids,
+    get_stops,
+)
+
+
+def validate_source(source):
+    """Check that a timetable source is empty, a URL or an absolute path."""
+    if source and not (
+        source.startswith(("http://", "https://")) or os.path.isabs(source)
+    ):
+        raise ValueError
+
+
+def format_feeds():
+    """Format the known feeds into a list of dictionaries with label and value."""
+    return [{"label": feed["name"], "value": key} for key, feed in FEEDS.items()]
 
 
 def format_stops(stops):
@@ -40,13 +78,49 @@ class NysseConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     def __init__(self) -> None:
         """Initialize."""
         self.data: dict[str, Any] = {}
+        self.feed = get_feed(DEFAULT_FEED)
         self.stations = []
         self.title = "Nysse"
 
     async def async_step_user(self, user_input: Optional[dict[str, Any]] = None):
         errors = {}
 
-        stops = await get_stops()
+        data_schema = {
+            vol.Required(CONF_FEED, default=DEFAULT_FEED): selector(
+                {
+                    "select": {
+                        "options": format_feeds(),
+                        "mode": "dropdown",
+                        "custom_value": "true",
+                    }
+                }
+            )
+        }
+
+        if user_input is not None:
+            try:
+                await self.validate_feed(user_input[CONF_FEED])
+            except ValueError:
+                errors[CONF_FEED] = "invalid_feed"
+
+            if not errors:
+                self.data[CONF_FEED] = user_input[CONF_FEED]
+                self.feed = get_feed(user_input[CONF_FEED])
+                return self.async_show_menu(
+                    step_id="entry_type",
+                    menu_options=["station", "nearby", "connection"],
+                )
+
+        return self.async_show_form(
+            step_id="user",
+            data_schema=vol.Schema(data_schema),
+            errors=errors,
+        )
+
+    async def async_step_station(self, user_input: Optional[dict[str, Any]] = None):
+        errors = {}
+
+        stops = await get_stops(self.feed)
         # TODO: check error handling
         if len(stops) == 0:
             errors["base"] = "no_stop_points"
@@ -71,9 +145,7 @@ class NysseConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
                 errors[CONF_STATION] = "invalid_station"
 
             if not errors:
-                await self.async_set_unique_id(user_input[CONF_STATION])
-                self._abort_if_unique_id_configured()
-                self.data[CONF_STATION] = user_input[CONF_STATION]
+                await self._async_set_station(user_input[CONF_STATION])
 
                 for station in self.stations:
                     if station["value"] == user_input[CONF_STATION]:
@@ -83,7 +155,131 @@ class NysseConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
                 return await self.async_step_options()
 
         return self.async_show_form(
-            step_id="user",
+            step_id="station",
+            data_schema=vol.Schema(data_schema),
+            errors=errors,
+        )
+
+    async def async_step_nearby(self, user_input: Optional[dict[str, Any]] = None):
+        errors = {}
+
+        stops = await get_nearest_stops(
+            self.feed, self.hass.config.latitude, self.hass.config.longitude, 10
+        )
+        if len(stops) == 0:
+            errors["base"] = "no_stop_points"
+        self.stations = [
+            {
+                "label": f"{stop['stop_name']} ({stop['stop_id']}), "
+                f"{stop['walking_distance']} m",
+                "value": stop["stop_id"],
+            }
+            for stop in stops
+        ]
+
+        data_schema = {
+            vol.Required(CONF_STATION): selector(
+                {"select": {"options": self.stations, "mode": "list"}}
+            )
+        }
+
+        if user_input is not None:
+            try:
+                await self.validate_stop(user_input[CONF_STATION])
+            except ValueError:
+                errors[CONF_STATION] = "invalid_station"
+
+            if not errors:
+                await self._async_set_station(user_input[CONF_STATION])
+
+                for stop in stops:
+                    if stop["stop_id"] == user_input[CONF_STATION]:
+                        self.title = f"{stop['stop_name']} ({stop['stop_id']})"
+                        break
+
+                return await self.async_step_options()
+
+        return self.async_show_form(
+            step_id="nearby",
+            data_schema=vol.Schema(data_schema),
+            errors=errors,
+        )
+
+    async def _async_set_station(self, stop_id):
+        if self.feed.feed_id == DEFAULT_FEED:
+            await self.async_set_unique_id(stop_id)
+        else:
+            await self.async_set_unique_id(f"{self.feed.feed_id}_{stop_id}")
+        self._abort_if_unique_id_configured()
+        self.data[CONF_STATION] = stop_id
+
+    async def async_step_connection(self, user_input: Optional[dict[str, Any]] = None):
+        errors = {}
+
+        stops = await get_stops(self.feed)
+        if len(stops) == 0:
+            errors["base"] = "no_stop_points"
+        self.stations = format_stops(stops)
+
+        stop_selector = selector(
+            {
+                "select": {
+                    "options": self.stations,
+                    "mode": "dropdown",
+                    "custom_value": "true",
+                }
+            }
+        )
+        data_schema = {
+            vol.Required(CONF_ORIGIN): stop_selector,
+            vol.Required(CONF_DESTINATION): stop_selector,
+            vol.Optional(CONF_MAX, default=DEFAULT_MAX): selector(
+                {"number": {"min": 1, "max": 30}}
+            ),
+        }
+
+        if user_input is not None:
+            for key in (CONF_ORIGIN, CONF_DESTINATION):
+                try:
+                    await self.validate_stop(user_input[key])
+                except ValueError:
+                    errors[key] = "invalid_station"
+
+            if not errors:
+                try:
+                    await self.validate_connection(
+                        user_input[CONF_ORIGIN], user_input[CONF_DESTINATION]
+                    )
+                except ValueError:
+                    errors[CONF_DESTINATION] = "no_connections"
+
+            if not errors:
+                unique_id = (
+                    f"connection_{user_input[CONF_ORIGIN]}"
+                    f"_{user_input[CONF_DESTINATION]}"
+                )
+                if self.feed.feed_id != DEFAULT_FEED:
+                    unique_id = f"{self.feed.feed_id}_{unique_id}"
+                await self.async_set_unique_id(unique_id)
+                self._abort_if_unique_id_configured()
+
+                labels = {
+                    station["value"]: station["label"] for station in self.stations
+                }
+                self.data = {
+                    "feed": self.data[CONF_FEED],
+                    "origin": user_input[CONF_ORIGIN],
+                    "destination": user_input[CONF_DESTINATION],
+                    "max": user_input[CONF_MAX],
+                }
+                return self.async_create_entry(
+                    title=f"{labels[user_input[CONF_ORIGIN]]} → "
+                    f"{labels[user_input[CONF_DESTINATION]]}",
+                    data=self.data,
+                )
+
+        return self.async_show_form(
+            step_id="connection",
             data_schema=vol.Schema(data_schema),
             errors=errors,
         )
@@ -91,7 +287,7 @@ class NysseConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     async def async_step_options(self, user_input: Optional[dict[str, Any]] = None):
         errors = {}
 
-        lines = await get_route_ids(self.data[CONF_STATION])
+        lines = await get_route_ids(self.feed, self.data[CONF_STATION])
         if len(lines) == 0:
             errors["base"] = "no_lines"
 
@@ -109,18 +305,35 @@ class NysseConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             vol.Optional(CONF_MAX, default=DEFAULT_MAX): selector(
                 {"number": {"min": 1, "max": 30}}
             ),
+            vol.Optional(CONF_PRUNED, default=DEFAULT_PRUNED): cv.boolean,
+            vol.Optional(CONF_COMPILED, default=DEFAULT_COMPILED): cv.boolean,
+            vol.Optional(CONF_HISTORY, default=DEFAULT_HISTORY): cv.boolean,
+            vol.Optional(CONF_VEHICLES, default=DEFAULT_VEHICLES): cv.boolean,
+            vol.Optional(CONF_TRIP_STOPS, default=DEFAULT_TRIP_STOPS): cv.boolean,
+            vol.Optional(CONF_SOURCE, default=DEFAULT_SOURCE): cv.string,
         }
         if user_input is not None:
             try:
                 await self.validate_lines(user_input[CONF_LINES])
             except ValueError:
                 errors[CONF_LINES] = "invalid_lines"
+            try:
+                validate_source(user_input[CONF_SOURCE])
+            except ValueError:
+                errors[CONF_SOURCE] = "invalid_source"
             if not errors:
                 self.data = {
+                    "feed": self.data[CONF_FEED],
                     "station": self.data[CONF_STATION],
                     "lines": user_input[CONF_LINES],
                     "timelimit": user_input[CONF_TIMELIMIT],
                     "max": user_input[CONF_MAX],
+                    "pruned_database": user_input[CONF_PRUNED],
+                    "compiled_timetable": user_input[CONF_COMPILED],
+                    "delay_history": user_input[CONF_HISTORY],
+                    "vehicle_tracking": user_input[CONF_VEHICLES],
+                    "trip_stops": user_input[CONF_TRIP_STOPS],
+                    "timetable_source": user_input[CONF_SOURCE],
                 }
                 return self.async_create_entry(title=self.title, data=self.data)
 
@@ -130,12 +343,26 @@ class NysseConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             errors=errors,
         )
 
+    async def validate_feed(self, feed):
+        if feed in FEEDS:
+            return
+        if not feed.startswith(("http://", "https://")):
+            raise ValueError
+
     async def validate_stop(self, stop_id):
         for station in self.stations:
             if station["value"] == stop_id:
                 return
         raise ValueError
 
+    async def validate_connection(self, origin_id, destination_id):
+        if origin_id == destination_id:
+            raise ValueError
+        if not await get_connections(
+            self.feed, origin_id, destination_id, 1, dt_util.now()
+        ):
+            raise ValueError
+
     async def validate_lines(self, lines):
         if len(lines) < 1:
             raise ValueError
@@ -163,8 +390,19 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
     ) -> dict[str, Any]:
         errors: dict[str, str] = {}
 
+        if CONF_ORIGIN in self.config_entry.data:
+            return await self._async_step_connection_options(user_input)
+
         if user_input is not None:
-            stops = await get_stops()
+            try:
+                validate_source(user_input[CONF_SOURCE])
+            except ValueError:
+                errors[CONF_SOURCE] = "invalid_source"
+
+        if user_input is not None and not errors:
+            stops = await get_stops(
+                get_feed(self.config_entry.data.get(CONF_FEED, DEFAULT_FEED))
+            )
             # TODO: check error handling
             if len(stops) == 0:
                 errors["base"] = "no_stop_points"
@@ -180,6 +418,12 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
                 "lines": self.config_entry.data[CONF_LINES],
                 "timelimit": user_input[CONF_TIMELIMIT],
                 "max": user_input[CONF_MAX],
+                "pruned_database": user_input[CONF_PRUNED],
+                "compiled_timetable": user_input[CONF_COMPILED],
+                "delay_history": user_input[CONF_HISTORY],
+                "vehicle_tracking": user_input[CONF_VEHICLES],
+                "trip_stops": user_input[CONF_TRIP_STOPS],
+                "timetable_source": user_input[CONF_SOURCE],
             }
             return self.async_create_entry(title="", data=self.data)
 
@@ -201,6 +445,42 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
                     vol.Optional(
                         CONF_MAX, default=self.config_entry.options[CONF_MAX]
                     ): selector({"number": {"min": 1, "max": 30}}),
+                    vol.Optional(
+                        CONF_PRUNED,
+                        default=self.config_entry.options.get(
+                            CONF_PRUNED, DEFAULT_PRUNED
+                        ),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_COMPILED,
+                        default=self.config_entry.options.get(
+                            CONF_COMPILED, DEFAULT_COMPILED
+                        ),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_HISTORY,
+                        default=self.config_entry.options.get(
+                            CONF_HISTORY, DEFAULT_HISTORY
+                        ),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_VEHICLES,
+                        default=self.config_entry.options.get(
+                            CONF_VEHICLES, DEFAULT_VEHICLES
+                        ),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_TRIP_STOPS,
+                        default=self.config_entry.options.get(
+                            CONF_TRIP_STOPS, DEFAULT_TRIP_STOPS
+                        ),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_SOURCE,
+                        default=self.config_entry.options.get(
+                            CONF_SOURCE, DEFAULT_SOURCE
+                        ),
+                    ): cv.string,
                 }
             )
         else:
@@ -221,6 +501,38 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
                     vol.Optional(
                         CONF_MAX, default=self.config_entry.data[CONF_MAX]
                     ): selector({"number": {"min": 1, "max": 30}}),
+                    vol.Optional(
+                        CONF_PRUNED,
+                        default=self.config_entry.data.get(CONF_PRUNED, DEFAULT_PRUNED),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_COMPILED,
+                        default=self.config_entry.data.get(
+                            CONF_COMPILED, DEFAULT_COMPILED
+                        ),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_HISTORY,
+                        default=self.config_entry.data.get(
+                            CONF_HISTORY, DEFAULT_HISTORY
+                        ),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_VEHICLES,
+                        default=self.config_entry.data.get(
+                            CONF_VEHICLES, DEFAULT_VEHICLES
+                        ),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_TRIP_STOPS,
+                        default=self.config_entry.data.get(
+                            CONF_TRIP_STOPS, DEFAULT_TRIP_STOPS
+                        ),
+                    ): cv.boolean,
+                    vol.Optional(
+                        CONF_SOURCE,
+                        default=self.config_entry.data.get(CONF_SOURCE, DEFAULT_SOURCE),
+                    ): cv.string,
                 }
             )
 
@@ -229,3 +541,24 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
             data_schema=options_schema,
             errors=errors,
         )
+
+    async def _async_step_connection_options(
+        self, user_input: dict[str, Any] = None
+    ) -> dict[str, Any]:
+        if user_input is not None:
+            self.data = {
+                "origin": self.config_entry.data[CONF_ORIGIN],
+                "destination": self.config_entry.data[CONF_DESTINATION],
+                "max": user_input[CONF_MAX],
+            }
+            return self.async_create_entry(title="", data=self.data)
+
+        config = self.config_entry.options or self.config_entry.data
+        options_schema = vol.Schema(
+            {
+                vol.Optional(CONF_MAX, default=config[CONF_MAX]): selector(
+                    {"number": {"min": 1, "max": 30}}
+                ),
+            }
+        )
+        return self.async_show_form(step_id="init", data_schema=options_schema)
@@ -4,12 +4,29 @@ DOMAIN = "nysse"
 
 PLATFORM_NAME = "Nysse"
 
+CONF_FEED = "feed"
+DEFAULT_FEED = "tampere"
 CONF_STATION = "station"
+CONF_ORIGIN = "origin"
+CONF_DESTINATION = "destination"
 CONF_TIMELIMIT = "timelimit"
 DEFAULT_TIMELIMIT = 0
 CONF_MAX = "max"
 DEFAULT_MAX = 3
 CONF_LINES = "lines"
+CONF_PRUNED = "pruned_database"
+DEFAULT_PRUNED = False
+CONF_COMPILED = "compiled_timetable"
+DEFAULT_COMPILED = False
+CONF_HISTORY = "delay_history"
+DEFAULT_HISTORY = False
+CONF_VEHICLES = "vehicle_tracking"
+DEFAULT_VEHICLES = False
+CONF_TRIP_STOPS = "trip_stops"
+DEFAULT_TRIP_STOPS = False
+# URL or path of a GTFS zip or a prebuilt bundle replacing the feed's GTFS URL
+CONF_SOURCE = "timetable_source"
+DEFAULT_SOURCE = ""
 DEFAULT_ICON = "mdi:bus-clock"
 TRAM_LINES = ["1", "3"]
 
@@ -17,6 +34,22 @@ STOP_URL = "https://data.itsfactory.fi/journeys/api/1/stop-monitoring?stops={0}"
 SERVICE_ALERTS_URL = (
     "https://data.itsfactory.fi/journeys/api/1/gtfs-rt/service-alerts/json"
 )
+TRIP_UPDATES_URL = "https://data.itsfactory.fi/journeys/api/1/gtfs-rt/trip-updates/json"
+VEHICLE_POSITIONS_URL = (
+    "https://data.itsfactory.fi/journeys/api/1/gtfs-rt/vehicle-positions/json"
+)
 GTFS_URL = (
     "https://data.itsfactory.fi/journeys/files/gtfs/latest/extended_gtfs_tampere.zip"
 )
+
+# Known GTFS feeds, other feeds can be configured with the URL of a GTFS zip
+FEEDS = {
+    "tampere": {
+        "name": "Tampere (Nysse)",
+        "gtfs_url": GTFS_URL,
+        "stop_url": STOP_URL,
+        "service_alerts_url": SERVICE_ALERTS_URL,
+        "trip_updates_url": TRIP_UPDATES_URL,
+        "vehicle_positions_url": VEHICLE_POSITIONS_URL,
+    },
+}
@@ -0,0 +1,214 @@
+"""Combines realtime and scheduled departures of a stop."""
+
+from __future__ import annotations
+
+from datetime import timedelta
+import logging
+
+from dateutil import parser
+from dateutil.parser import ParserError
+import isodate
+
+from homeassistant import core
+import homeassistant.util.dt as dt_util
+
+from .const import TRAM_LINES
+from .fetch_api import Feed, StopTime
+from .network import get_cached
+from .realtime import get_line_delays, get_trip_delay, parse_trip_updates
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _parse_delay(stop_id, delay):
+    try:
+        return int(isodate.parse_duration(delay).total_seconds())
+    except (OSError, ValueError) as err:
+        _LOGGER.debug("%s: Failed to format delay: %s", stop_id, err)
+        return 0
+
+
+def parse_departures(data, stop_id, get_stop_name):
+    """Parse a stop monitoring response into realtime departures.
+
+    Args:
+        data (dict): The response in JSON format.
+        stop_id (str): The ID of the stop.
+        get_stop_name (Callable): Gets the name of a stop by its ID.
+
+    Returns:
+        list: Realtime departures as StopTime tuples.
+
+    """
+    try:
+        body = data["body"][stop_id]
+        departures: list[StopTime] = []
+        for departure in body:
+            try:
+                departures.append(
+                    StopTime(
+                        departure["lineRef"],
+                        get_stop_name(departure["destinationShortName"]),
+                        parser.parse(departure["call"]["expectedDepartureTime"]),
+                        parser.parse(departure["call"]["aimedDepartureTime"]),
+                        _parse_delay(stop_id, departure["delay"]),
+                        0,
+                        True,
+                    )
+                )
+            except (KeyError, ParserError) as err:
+                _LOGGER.info(
+                    "%s: Failed to process realtime departure: %s", stop_id, err
+                )
+                continue
+        return departures
+    except KeyError as err:
+        _LOGGER.info(
+            "%s: Nysse API error: failed to process realtime data: %s", stop_id, err
+        )
+        return []
+    except OSError as err:
+        _LOGGER.info("%s: failed to process realtime data: %s", stop_id, err)
+        return []
+
+
+def _is_same_departure(journey: StopTime, departure: StopTime):
+    return (
+        journey.departure_time == departure.aimed_departure_time
+        and journey.route_id == departure.route_id
+    )
+
+
+def remove_realtime_journeys(journeys: list[StopTime], departures: list[StopTime]):
+    """Leave out scheduled departures that are also listed in realtime.
+
+    Realtime departures do not identify their trips, so they take the trip ID
+    and stop sequence of the matching scheduled departure.
+
+    Args:
+        journeys (list): Scheduled departures as StopTime tuples.
+        departures (list): Realtime departures as StopTime tuples.
+
+    Returns:
+        tuple: The realtime departures with the trips of matched scheduled
+        departures, and the scheduled departures missing from the realtime
+        departures.
+
+    """
+    matched_departures = []
+    for departure in departures:
+        journey = next(
+            (journey for journey in journeys if _is_same_departure(journey, departure)),
+            None,
+        )
+        if journey is not None:
+            departure = departure._replace(
+                trip_id=journey.trip_id, stop_sequence=journey.stop_sequence
+            )
+        matched_departures.append(departure)
+    remaining_journeys = [
+        journey
+        for journey in journeys
+        if not any(_is_same_departure(journey, departure) for departure in departures)
+    ]
+    return matched_departures, remaining_journeys
+
+
+async def predict_delays(
+    hass: core.HomeAssistant,
+    feed: Feed,
+    journeys: list[StopTime],
+    departures: list[StopTime],
+    now,
+    delay_statistics=None,
+):
+    """Shift scheduled departures by their predicted delays.
+
+    Delays are taken from the same trip at upstream stops, or estimated from
+    the realtime departures of the line or its recorded mean delay.
+
+    Args:
+        hass (HomeAssistant): Home Assistant instance.
+        feed (Feed): The feed the departures belong to.
+        journeys (list): Scheduled departures as StopTime tuples.
+        departures (list): Realtime departures of the same stop.
+        now (datetime): The current time. Departures that would have already
+            left with the delay are not shifted.
+        delay_statistics (list): Delay statistics of the lines, if recorded.
+
+    Returns:
+        list: The scheduled departures with predicted delays.
+
+    """
+    trip_delays = {}
+    if feed.trip_updates_url is not None and len(journeys) > 0:
+        response = await get_cached(feed.trip_updates_url)
+        if response.data is not None:
+            trip_delays = await hass.async_add_executor_job(
+                parse_trip_updates, feed.trip_updates_url, response.data
+            )
+    line_delays = get_line_delays(departures)
+    for statistics in delay_statistics or []:
+        line_delays.setdefault(statistics["line"], statistics["mean"])
+
+    predicted_journeys = []
+    for journey in journeys:
+        delay = get_trip_delay(trip_delays, journey.trip_id, journey.stop_sequence)
+        if delay is None:
+            delay = line_delays.get(journey.route_id)
+        departure_time = journey.departure_time + timedelta(days=journey.delta_days)
+        if delay is None or departure_time + timedelta(seconds=delay) < now:
+            predicted_journeys.append(journey)
+            continue
+        predicted_journeys.append(
+            journey._replace(
+                departure_time=journey.departure_time + timedelta(seconds=delay),
+                aimed_departure_time=journey.departure_time,
+                delay=delay,
+                predicted=True,
+            )
+        )
+    return predicted_journeys
+
+
+def get_departure_time(item: StopTime):
+    """Get the local departure time of a departure on its day."""
+    return dt_util.as_local(item.departure_time) + timedelta(days=item.delta_days)
+
+
+def _get_time_to_station(item: StopTime, now):
+    try:
+        return int((get_departure_time(item) - now).seconds / 60)
+    except OSError as err:
+        _LOGGER.debug("Failed to calculate time to station: %s", err)
+        return 0
+
+
+def format_departure(item: StopTime, now):
+    """Format a departure for state attributes and service responses.
+
+    Args:
+        item (StopTime): The departure.
+        now (datetime): The time the time to station is counted from.
+
+    Returns:
+        dict: The departure.
+
+    """
+    departure = {
+        "destination": item.trip_headsign,
+        "line": item.route_id,
+        "departure": item.departure_time.strftime("%H:%M"),
+        "time_to_station": _get_time_to_station(item, now),
+        "icon": "mdi:tram" if item.route_id in TRAM_LINES else "mdi:bus",
+        "realtime": item.realtime,
+    }
+    if item.aimed_departure_time is not None:
+        departure["aimed_departure"] = item.aimed_departure_time.strftime("%H:%M")
+    if item.delay is not None:
+        departure["delay"] = item.delay
+    if item.predicted:
+        departure["predicted"] = True
+    if item.trip_id is not None:
+        departure["trip_id"] = item.trip_id
+    return departure
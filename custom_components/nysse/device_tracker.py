@@ -0,0 +1,192 @@
+"""Platform for tracking vehicles approaching stops."""
+
+from __future__ import annotations
+
+import logging
+
+from homeassistant import config_entries, core
+from homeassistant.components.device_tracker import SourceType, TrackerEntity
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+
+from .const import (
+    CONF_FEED,
+    CONF_ORIGIN,
+    CONF_VEHICLES,
+    DEFAULT_FEED,
+    DEFAULT_VEHICLES,
+    PLATFORM_NAME,
+    TRAM_LINES,
+)
+from .fetch_api import (
+    Feed,
+    get_feed,
+    get_stop_sequences,
+    get_stops,
+    get_vehicle_tracker,
+    is_database_ready,
+    start_gtfs_fetch,
+)
+from .network import get_cached
+from .scheduler import async_schedule_updates
+from .vehicles import Vehicle
+
+_LOGGER = logging.getLogger(__name__)
+
+
+async def async_setup_entry(
+    hass: core.HomeAssistant,
+    config_entry: config_entries.ConfigEntry,
+    async_add_entities: AddEntitiesCallback,
+) -> None:
+    """Set up a vehicle tracker for a stop if enabled in its config entry."""
+    if CONF_ORIGIN in config_entry.data:
+        return  # Connections are not tracked
+    if "station" in config_entry.options:
+        config = config_entry.options
+    else:
+        config = config_entry.data
+    feed = get_feed(config_entry.data.get(CONF_FEED, DEFAULT_FEED))
+    if (
+        not config.get(CONF_VEHICLES, DEFAULT_VEHICLES)
+        or feed.vehicle_positions_url is None
+    ):
+        return
+    async_add_entities(
+        [
+            NysseVehicleTracker(
+                feed, config["station"], config["lines"], config_entry.title
+            )
+        ]
+    )
+
+
+class NysseVehicleTracker(TrackerEntity):
+    """Location of the nearest vehicle approaching a stop."""
+
+    _attr_should_poll = False
+
+    def __init__(self, feed: Feed, stop_code, lines, title) -> None:
+        """Initialize the tracker."""
+        self._feed = feed
+        self._stop_code = stop_code
+        self._lines = lines
+        self._title = title
+        self._registered = False
+        self._vehicle: Vehicle | None = None
+
+    async def async_added_to_hass(self) -> None:
+        """Update the tracker now and periodically after that."""
+        self.async_schedule_update_ha_state(True)
+        self.async_on_remove(async_schedule_updates(self.hass, self))
+
+    async def async_will_remove_from_hass(self) -> None:
+        """Stop tracking vehicles for the stop."""
+        get_vehicle_tracker(self._feed).unregister_stop(self._stop_code)
+
+    async def _register_stop(self):
+        if not is_database_ready(self._feed):
+            start_gtfs_fetch(self._feed)
+            return
+        for stop in await get_stops(self._feed):
+            if stop["stop_id"] != self._stop_code:
+                continue
+            if stop["stop_lat"] is None or stop["stop_lon"] is None:
+                _LOGGER.warning("%s: Stop has no coordinates", self._stop_code)
+            else:
+                get_vehicle_tracker(self._feed).register_stop(
+                    self._stop_code, stop["stop_lat"], stop["stop_lon"], self._lines
+                )
+            self._registered = True
+            return
+        # The stops may not be loaded yet, so registering is retried
+        _LOGGER.debug("%s: Stop not found", self._stop_code)
+
+    async def async_update(self) -> None:
+        """Find the nearest vehicle approaching the stop."""
+        if not self._registered:
+            await self._register_stop()
+            if not self._registered:
+                return
+
+        response = await get_cached(self._feed.vehicle_positions_url)
+        if response.data is None:
+            self._vehicle = None
+            return
+        tracker = get_vehicle_tracker(self._feed)
+        await tracker.async_update(self.hass, response.data)
+        candidates = tracker.get_candidates(self._stop_code)
+
+        # Vehicles that have already passed the stop are skipped
+        sequences = await get_stop_sequences(
+            self._feed,
+            self._stop_code,
+            [vehicle.trip_id for vehicle in candidates if vehicle.trip_id],
+        )
+        self._vehicle = next(
+            (
+                vehicle
+                for vehicle in candidates
+                if vehicle.current_stop_sequence is None
+                or vehicle.trip_id not in sequences
+                or vehicle.current_stop_sequence <= sequences[vehicle.trip_id]
+            ),
+            None,
+        )
+
+    @property
+    def unique_id(self) -> str:
+        """Unique id for the tracker."""
+        if self._feed.feed_id == DEFAULT_FEED:
+            return PLATFORM_NAME + "_vehicle_" + self._stop_code
+        return PLATFORM_NAME + "_" + self._feed.feed_id + "_vehicle_" + self._stop_code
+
+    @property
+    def name(self) -> str:
+        """Return the name of the tracker."""
+        return f"{self._title} vehicle"
+
+    @property
+    def icon(self) -> str:
+        """Icon of the tracker."""
+        if self._vehicle is not None and self._vehicle.route_id in TRAM_LINES:
+            return "mdi:tram"
+        return "mdi:bus"
+
+    @property
+    def source_type(self) -> SourceType:
+        """Return the source type of the tracker."""
+        return SourceType.GPS
+
+    @property
+    def latitude(self) -> float | None:
+        """Return the latitude of the vehicle."""
+        if self._vehicle is None:
+            return None
+        return self._vehicle.latitude
+
+    @property
+    def longitude(self) -> float | None:
+        """Return the longitude of the vehicle."""
+        if self._vehicle is None:
+            return None
+        return self._vehicle.longitude
+
+    @property
+    def location_accuracy(self) -> int:
+        """Return the accuracy of the location in meters."""
+        return 0
+
+    @property
+    def extra_state_attributes(self):
+        """Tracker attributes."""
+        if self._vehicle is None:
+            return {"station_id": self._stop_code}
+        return {
+            "station_id": self._stop_code,
+            "line": self._vehicle.route_id,
+            "vehicle_id": self._vehicle.vehicle_id,
+            "trip_id": self._vehicle.trip_id,
+            "distance": self._vehicle.distance,
+            "bearing": self._vehicle.bearing,
+            "speed": self._vehicle.speed,
+        }
@@ -1,12 +1,19 @@
 """Fetches data from the Nysse GTFS API."""
 
 import asyncio
-import csv
+import bisect
+from concurrent import futures
 from datetime import UTC, datetime, timedelta
+import hashlib
+import json
 import logging
+import math
+import multiprocessing
 import os
 import pathlib
+import shutil
 import sqlite3
+import time
 from typing import NamedTuple
 import zipfile
 
@@ -15,219 +22,623 @@ from dateutil import parser
 
 import homeassistant.util.dt as dt_util
 
-from .const import DOMAIN, GTFS_URL
+from .bundle import install_bundle, is_bundle
+from .cache import SingleFlight
+from .const import DEFAULT_FEED, DOMAIN, FEEDS
+from .history import HISTORY_FILENAME, DelayHistory
+from .importer import SCHEMA_VERSION, check_database, compact_database, import_csv_files
+from .timetable import TIMETABLE_FILENAME, TIMETABLE_VERSION, Timetable
+from .vehicles import VehicleTracker, get_distance
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class Feed(NamedTuple):
+    feed_id: str
+    name: str
+    gtfs_url: str
+    stop_url: str | None
+    service_alerts_url: str | None
+    trip_updates_url: str | None
+    vehicle_positions_url: str | None
+
+
+def get_feed(feed):
+    """Get the URLs of a configured feed.
+
+    Args:
+        feed (str): Key of a known feed in FEEDS or the URL of a GTFS zip.
+
+    Returns:
+        Feed: The feed. Custom feeds have no realtime data.
+
+    """
+    if feed in FEEDS:
+        return Feed(feed, **FEEDS[feed])
+    # Custom feeds are stored in a partition named after their URL
+    feed_id = hashlib.sha1(feed.encode("utf-8")).hexdigest()[:12]
+    return Feed(feed_id, feed, feed, None, None, None, None)
+
+
 def _get_data_path():
     return os.path.abspath(
         os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
     )
 
 
-def _get_dir_path():
-    dir_path = os.path.join(_get_data_path(), f"www/{DOMAIN}/")
-    pathlib.Path(dir_path).mkdir(parents=True, exist_ok=True)
+def _get_dir_path(feed: Feed):
+    dir_path = _dir_paths.get(feed.feed_id)
+    if dir_path is None:
+        dir_path = os.path.join(_get_data_path(), f"www/{DOMAIN}/{feed.feed_id}/")
+        if not os.path.isdir(dir_path):
+            pathlib.Path(dir_path).mkdir(parents=True, exist_ok=True)
+            if feed.feed_id == DEFAULT_FEED:
+                _migrate_legacy_files(dir_path)
+        _dir_paths[feed.feed_id] = dir_path
     return dir_path
 
 
-def _get_database():
-    # Connect to the SQLite database (or create it if it doesn't exist)
-    conn = sqlite3.connect(_get_dir_path() + "database.db")
+def _migrate_legacy_files(dir_path):
+    # Older versions stored a single Tampere feed directly in www/nysse
+    legacy_path = os.path.join(_get_data_path(), f"www/{DOMAIN}/")
+    if not os.path.isfile(legacy_path + "extended_gtfs_tampere.zip"):
+        return
+    _LOGGER.info("Moving GTFS data from %s to %s", legacy_path, dir_path)
+    os.replace(legacy_path + "extended_gtfs_tampere.zip", dir_path + GTFS_FILENAME)
+    for filename in os.listdir(legacy_path):
+        if filename.endswith(".txt") or filename == "database.db":
+            os.replace(legacy_path + filename, dir_path + filename)
+
+
+# The database is only replaced as a whole, never modified in place, so reads
+# can be served from memory-mapped pages shared by all connections
+_READ_PRAGMAS = (
+    "PRAGMA mmap_size = 67108864",
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+def _get_database(feed: Feed):
+    # Connect to the SQLite database read-only
+    uri = pathlib.Path(_get_dir_path(feed) + "database.db").as_uri()
+    conn = sqlite3.connect(uri + "?mode=ro", uri=True)
     conn.row_factory = sqlite3.Row
+    for pragma in _READ_PRAGMAS:
+        conn.execute(pragma)
 
     # Create a cursor object to execute SQL queries
     cursor = conn.cursor()
     return conn, cursor
 
 
-_fetch_lock = asyncio.Lock()
+def _query_database(feed: Feed, query, args):
+    conn, cursor = _get_database(feed)
+    try:
+        return query(cursor, *args)
+    finally:
+        conn.close()
+
+
+async def _run_query(feed: Feed, query, *args):
+    """Call query(cursor, *args) with a database cursor in the executor.
+
+    Only a few queries run at a time, so bursts of updates leave executor
+    threads and disk bandwidth for the rest of Home Assistant.
+    """
+    async with _query_semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _query_database, feed, query, args)
+
+
+GTFS_FILENAME = "gtfs.zip"
+# Records the URL or path gtfs.zip was fetched from
+GTFS_SOURCE_FILENAME = "gtfs_source.txt"
+GTFS_FETCH_INTERVAL = timedelta(hours=1)
+
+# State of each feed partition, keyed by feed ID
+_fetch_locks: dict[str, asyncio.Lock] = {}
+_fetch_tasks: dict[str, asyncio.Task] = {}
+_last_fetch_times: dict[str, datetime] = {}
+# Source of the GTFS file fetched for each feed
+_fetched_sources: dict[str, str] = {}
+_dir_paths: dict[str, str] = {}
+_loaded_feeds: set[str] = set()
+_ready_feeds: set[str] = set()
+_pruned_stops: dict[str, set[str]] = {}
+_timetable_sources: dict[str, str] = {}
+_compiled_feeds: set[str] = set()
+_timetables: dict[str, Timetable | None] = {}
+_database_meta: dict[str, dict[str, str]] = {}
+_delay_histories: dict[str, DelayHistory] = {}
+_connections: dict[tuple[str, str, str, str], list[tuple]] = {}
+_trips: dict[tuple[str, str], tuple] = {}
+_trip_patterns: dict[tuple[str, tuple[int, ...]], tuple[tuple[str, str], ...]] = {}
+_vehicle_trackers: dict[str, VehicleTracker] = {}
+_import_executor: futures.ProcessPoolExecutor | None = None
+_running_imports = 0
+# Worker processes parsing GTFS files at most, or None for one per CPU. Each
+# worker is a spawned interpreter that imports the integration package, which
+# costs far more memory than the chunk of a file it parses at a time
+MAX_IMPORT_WORKERS: int | None = None
+# Identical concurrent queries share one result, e.g. during startup
+_queries = SingleFlight()
+# Database queries running at the same time at most
+MAX_CONCURRENT_QUERIES = 2
+_query_semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+
+
+async def async_load_feed(feed: Feed):
+    """Load the state of the files of a feed in the executor.
+
+    The readiness and metadata of the database are cached, so checking them
+    later does no I/O in the event loop.
+
+    Args:
+        feed (Feed): The feed to load.
+
+    """
+    if feed.feed_id not in _loaded_feeds:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _load_feed_state, feed)
+
+
+def _load_feed_state(feed: Feed):
+    path = _get_dir_path(feed)
+    source = _read_fetched_source(path, feed.gtfs_url)
+    if source is not None:
+        _fetched_sources[feed.feed_id] = source
+    # The database is swapped in atomically, so its presence means it is complete
+    if os.path.isfile(path + "database.db"):
+        _database_meta[feed.feed_id] = _read_database_meta(feed)
+        _ready_feeds.add(feed.feed_id)
+    _loaded_feeds.add(feed.feed_id)
+
+
+def is_database_ready(feed: Feed):
+    """Check whether a timetable database is available for queries.
+
+    Only cached state is checked, see async_load_feed.
+
+    Args:
+        feed (Feed): The feed to check.
+
+    Returns:
+        bool: True if GTFS data has been imported at least once.
+
+    """
+    return feed.feed_id in _ready_feeds
+
+
+def get_delay_history(feed: Feed):
+    """Get the delay history of a feed.
+
+    The history is stored separately from the timetable database, so it is
+    kept when GTFS data is imported again.
+
+    Args:
+        feed (Feed): The feed to get the history of.
+
+    Returns:
+        DelayHistory: The delay history.
+
+    """
+    if feed.feed_id not in _delay_histories:
+        _delay_histories[feed.feed_id] = DelayHistory(
+            _get_dir_path(feed) + HISTORY_FILENAME
+        )
+    return _delay_histories[feed.feed_id]
+
+
+def get_vehicle_tracker(feed: Feed):
+    """Get the tracker of vehicles approaching configured stops of a feed.
+
+    Args:
+        feed (Feed): The feed to get the tracker of.
+
+    Returns:
+        VehicleTracker: The vehicle tracker.
+
+    """
+    if feed.feed_id not in _vehicle_trackers:
+        _vehicle_trackers[feed.feed_id] = VehicleTracker()
+    return _vehicle_trackers[feed.feed_id]
+
+
+def get_feed_version(feed: Feed):
+    """Get the version of the imported GTFS data of a feed.
+
+    Args:
+        feed (Feed): The feed to check.
+
+    Returns:
+        str: The version given in feed_info.txt, or None if the feed has no
+        version or has not been imported.
+
+    """
+    if not is_database_ready(feed):
+        return None
+    return _database_meta.get(feed.feed_id, {}).get("feed_version")
+
+
+def set_pruned_stops(feed: Feed, stop_ids):
+    """Limit the imported timetable to the given stops.
+
+    Trips serving other stops are left out of the database. The database is
+    rebuilt on the next fetch if it does not contain all the given stops.
+
+    Args:
+        feed (Feed): The feed to prune.
+        stop_ids (set): IDs of the stops to keep timetables for, or None to
+            keep timetables for all stops.
+
+    """
+    if stop_ids is not None:
+        _pruned_stops[feed.feed_id] = set(stop_ids)
+    else:
+        _pruned_stops.pop(feed.feed_id, None)
+
+
+def set_timetable_source(feed: Feed, source):
+    """Fetch the timetable of a feed from another source.
+
+    The source may be the URL or local path of a GTFS zip or of a prebuilt
+    bundle. Bundles are installed without importing anything.
+
+    Args:
+        feed (Feed): The feed to configure.
+        source (str): URL or absolute path of the file, or None to use the
+            GTFS URL of the feed.
+
+    """
+    if source:
+        _timetable_sources[feed.feed_id] = source
+    else:
+        _timetable_sources.pop(feed.feed_id, None)
+
+
+def set_compiled_timetable(feed: Feed, enabled):
+    """Enable or disable the compiled timetable of a feed.
+
+    The compiled timetable is written on the next import and used for
+    departure lookups instead of database queries.
+
+    Args:
+        feed (Feed): The feed to configure.
+        enabled (bool): Whether to use a compiled timetable.
+
+    """
+    if enabled:
+        _compiled_feeds.add(feed.feed_id)
+    else:
+        _compiled_feeds.discard(feed.feed_id)
+        _timetables.pop(feed.feed_id, None)
+
+
+def _read_database_meta(feed: Feed):
+    conn, cursor = _get_database(feed)
+    try:
+        cursor.execute("SELECT key, value FROM meta")
+        return {row["key"]: row["value"] for row in cursor.fetchall()}
+    except sqlite3.OperationalError:
+        # Database was created by an older version without metadata
+        return {}
+    finally:
+        conn.close()
+
+
+async def _get_database_meta(feed: Feed):
+    if feed.feed_id not in _database_meta:
+        loop = asyncio.get_running_loop()
+        _database_meta[feed.feed_id] = await loop.run_in_executor(
+            None, _read_database_meta, feed
+        )
+    return _database_meta[feed.feed_id]
+
+
+async def _has_current_schema(feed: Feed):
+    if not is_database_ready(feed):
+        return False
+    meta = await _get_database_meta(feed)
+    return meta.get("schema_version") == str(SCHEMA_VERSION)
 
 
-async def _fetch_gtfs():
+async def _is_import_needed(feed: Feed):
+    if not await _has_current_schema(feed):
+        return True
+    meta = await _get_database_meta(feed)
+    if "bundle" in meta:
+        return False  # Prebuilt databases are used as they are
+    if feed.feed_id in _compiled_feeds and meta.get("compiled_timetable") != str(
+        TIMETABLE_VERSION
+    ):
+        return True
+    if "pruned_stops" not in meta:
+        return False  # Full timetable contains every stop
+    pruned_stops = _pruned_stops.get(feed.feed_id)
+    if pruned_stops is None:
+        return True
+    return not pruned_stops.issubset(json.loads(meta["pruned_stops"]))
+
+
+def start_gtfs_fetch(feed: Feed):
+    """Start fetching GTFS data of a feed in the background.
+
+    Feeds are fetched independently, so several feeds can be imported at
+    the same time.
+
+    Args:
+        feed (Feed): The feed to fetch.
+
+    Returns:
+        asyncio.Task: The task running the fetch. Calls made while a fetch is
+        in progress return the same task.
+
+    """
+    task = _fetch_tasks.get(feed.feed_id)
+    if task is None or task.done():
+        task = asyncio.create_task(_fetch_gtfs(feed))
+        _fetch_tasks[feed.feed_id] = task
+    return task
+
+
+def _is_fetch_due(feed: Feed):
+    source = _timetable_sources.get(feed.feed_id, feed.gtfs_url)
+    last_fetch_time = _last_fetch_times.get(feed.feed_id)
+    return (
+        _fetched_sources.get(feed.feed_id) != source
+        or last_fetch_time is None
+        or datetime.now() - last_fetch_time >= GTFS_FETCH_INTERVAL
+    )
+
+
+async def _ensure_gtfs(feed: Feed):
+    await async_load_feed(feed)
+    if not await _has_current_schema(feed):
+        # Nothing to serve from yet, wait for the import
+        await start_gtfs_fetch(feed)
+        return await _has_current_schema(feed)
+    if _is_fetch_due(feed) or await _is_import_needed(feed):
+        # The existing database serves queries while it is rebuilt
+        start_gtfs_fetch(feed)
+    return True
+
+
+async def _fetch_gtfs(feed: Feed):
     try:
-        async with _fetch_lock:  # Ensure only one fetch runs at a time
-            path = _get_dir_path()
-            filename = "extended_gtfs_tampere.zip"
-            if os.path.isfile(path + filename) and datetime.now().minute != 0:
+        lock = _fetch_locks.setdefault(feed.feed_id, asyncio.Lock())
+        async with lock:  # Ensure only one fetch runs at a time per feed
+            await async_load_feed(feed)
+            if not _is_fetch_due(feed):
+                if await _is_import_needed(feed):
+                    _LOGGER.debug("Importing previously fetched GTFS data")
+                    await _update_database(feed)
+                    return
                 _LOGGER.debug("Skipped fetching GTFS data")
-                return  # Skip fetching if the file exists or it's not the top of the hour
-            timestamp = _get_file_modified_time(path + filename)
+                return  # Skip fetching if the file was checked recently
+
+            path = _get_dir_path(feed)
+            source = _timetable_sources.get(feed.feed_id, feed.gtfs_url)
+            same_source = _fetched_sources.get(feed.feed_id) == source
+            loop = asyncio.get_running_loop()
+            if os.path.isabs(source):
+                _last_fetch_times[feed.feed_id] = datetime.now()
+                copied = await loop.run_in_executor(
+                    None, _copy_local_file, source, path, same_source
+                )
+                _fetched_sources[feed.feed_id] = source
+                if copied or await _is_import_needed(feed):
+                    await _update_database(feed)
+                return
 
-            _LOGGER.debug("Fetching GTFS data from %s", GTFS_URL)
+            # A file from another source must be fetched even if it is older
+            timestamp = _get_file_modified_time(
+                path + GTFS_FILENAME if same_source else None
+            )
+
+            _LOGGER.debug("Fetching GTFS data from %s", source)
             timeout = aiohttp.ClientTimeout(total=30)
             async with (
                 aiohttp.ClientSession(timeout=timeout) as session,
                 session.get(
-                    GTFS_URL, headers={"If-Modified-Since": timestamp}
+                    source, headers={"If-Modified-Since": timestamp}
                 ) as response,
             ):
+                _last_fetch_times[feed.feed_id] = datetime.now()
                 if response.status == 200:
                     _LOGGER.info("Response OK")
                     content = await response.read()
-                    loop = asyncio.get_running_loop()
                     await loop.run_in_executor(
-                        None, _save_response_to_file, path, filename, content
+                        None, _save_response_to_file, path, GTFS_FILENAME, content
                     )
-                    await _read_csv_to_db()
+                    await loop.run_in_executor(None, _unpack_gtfs, path, source)
+                    _fetched_sources[feed.feed_id] = source
+                    await _update_database(feed)
                 elif response.status == 304:
                     _LOGGER.debug(
-                        "%s has not received updates: %s", filename, response.status
+                        "%s has not received updates: %s",
+                        source,
+                        response.status,
                     )
+                    if await _is_import_needed(feed):
+                        await _update_database(feed)
                 else:
                     _LOGGER.error(
                         "Error fetching GTFS data: Status %s", response.status
                     )
     except aiohttp.ClientError as err:
         _LOGGER.error("Error fetching GTFS data: %s", err)
+    except (
+        OSError,
+        KeyError,
+        ValueError,
+        sqlite3.Error,
+        zipfile.BadZipFile,
+        futures.BrokenExecutor,
+    ) as err:
+        _LOGGER.error("Error importing GTFS data: %s", err)
 
 
 def _save_response_to_file(path, filename, content):
     with open(path + filename, "wb") as f:
         f.write(content)
-    with zipfile.ZipFile(path + filename, "r") as zip_ref:
-        zip_ref.extractall(path)
 
 
-async def _read_csv_to_db():
-    loop = asyncio.get_running_loop()
-    path = _get_dir_path()
-    stops = await loop.run_in_executor(None, _parse_csv_file, path + "stops.txt")
-    trips = await loop.run_in_executor(None, _parse_csv_file, path + "trips.txt")
-    calendar = await loop.run_in_executor(None, _parse_csv_file, path + "calendar.txt")
-    stop_times = await loop.run_in_executor(
-        None, _parse_csv_file, path + "stop_times.txt"
-    )
+def _read_fetched_source(path, default_source):
+    if not os.path.isfile(path + GTFS_FILENAME):
+        return None
+    try:
+        with open(path + GTFS_SOURCE_FILENAME, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        # Fetched by an older version, always from the default source
+        return default_source
 
-    conn, cursor = _get_database()
 
-    # Stops
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS stops (
-            stop_id TEXT PRIMARY KEY,
-            stop_name TEXT,
-            stop_lat TEXT,
-            stop_lon TEXT
-        )
-        """
-    )
-    to_db = [
-        (i["stop_id"], i["stop_name"], i["stop_lat"], i["stop_lon"]) for i in stops
-    ]
-    cursor.executemany(
-        "INSERT OR REPLACE INTO stops (stop_id, stop_name, stop_lat, stop_lon) VALUES (?, ?, ?, ?)",
-        to_db,
-    )
+def _unpack_gtfs(path, source):
+    # Bundles are installed as they are, GTFS data is extracted for import
+    if not is_bundle(path + GTFS_FILENAME):
+        with zipfile.ZipFile(path + GTFS_FILENAME, "r") as zip_ref:
+            zip_ref.extractall(path)
+    with open(path + GTFS_SOURCE_FILENAME, "w", encoding="utf-8") as f:
+        f.write(source)
 
-    # Routes
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS trips (
-            trip_id TEXT PRIMARY KEY,
-            route_id TEXT,
-            service_id TEXT,
-            trip_headsign TEXT,
-            direction_id TEXT
-        )
-        """
+
+def _copy_local_file(source, path, same_source):
+    """Copy a local GTFS zip or bundle if it has changed since the last copy.
+
+    Returns:
+        bool: True if the file was copied.
+
+    """
+    target = path + GTFS_FILENAME
+    if (
+        same_source
+        and os.path.isfile(target)
+        and os.path.getmtime(source) <= os.path.getmtime(target)
+    ):
+        return False
+    shutil.copyfile(source, target)
+    _unpack_gtfs(path, source)
+    return True
+
+
+async def _update_database(feed: Feed):
+    path = _get_dir_path(feed)
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, is_bundle, path + GTFS_FILENAME):
+        await _read_csv_to_db(feed)
+        return
+    manifest = await loop.run_in_executor(
+        None, install_bundle, path + GTFS_FILENAME, path
     )
-    to_db = [
-        (
-            i["trip_id"],
-            i["route_id"],
-            i["service_id"],
-            i["trip_headsign"],
-            i["direction_id"],
-        )
-        for i in trips
-    ]
-    cursor.executemany(
-        """
-        INSERT OR REPLACE INTO trips
-        (trip_id, route_id, service_id, trip_headsign, direction_id)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        to_db,
+    _LOGGER.info(
+        "Installed timetable bundle %s of %s", manifest["version"], feed.feed_id
     )
+    _database_meta.pop(feed.feed_id, None)
+    _on_database_replaced(feed)
 
-    # Calendar
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS calendar (
-            service_id TEXT PRIMARY KEY,
-            monday TEXT,
-            tuesday TEXT,
-            wednesday TEXT,
-            thursday TEXT,
-            friday TEXT,
-            saturday TEXT,
-            sunday TEXT,
-            start_date TEXT,
-            end_date TEXT
+
+def _on_database_replaced(feed: Feed):
+    _ready_feeds.add(feed.feed_id)
+    _timetables.pop(feed.feed_id, None)  # Map the new file on next lookup
+    _queries.clear()
+    _connections.clear()
+    _trips.clear()
+    _trip_patterns.clear()
+
+
+async def _read_csv_to_db(feed: Feed):
+    global _import_executor, _running_imports
+    if _import_executor is None:
+        # Workers are started on demand and stopped when no import is running
+        workers = os.cpu_count() or 1
+        if MAX_IMPORT_WORKERS is not None:
+            workers = min(workers, MAX_IMPORT_WORKERS)
+        _import_executor = futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
         )
-        """
-    )
-    to_db = [
-        (
-            i["service_id"],
-            i["monday"],
-            i["tuesday"],
-            i["wednesday"],
-            i["thursday"],
-            i["friday"],
-            i["saturday"],
-            i["sunday"],
-            i["start_date"],
-            i["end_date"],
+    _running_imports += 1
+    try:
+        loop = asyncio.get_running_loop()
+        _database_meta[feed.feed_id] = await loop.run_in_executor(
+            None,
+            import_csv_files,
+            _get_dir_path(feed),
+            _pruned_stops.get(feed.feed_id),
+            feed.feed_id in _compiled_feeds,
+            _import_executor,
         )
-        for i in calendar
-    ]
-    cursor.executemany(
-        """
-        INSERT OR REPLACE INTO calendar
-        (service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday, start_date, end_date)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        to_db,
-    )
+        _on_database_replaced(feed)
+    finally:
+        _running_imports -= 1
+        if _running_imports == 0 and _import_executor is not None:
+            _import_executor.shutdown(wait=False)
+            _import_executor = None
 
-    # Stop times
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS stop_times (
-            trip_id TEXT,
-            arrival_time TIME,
-            departure_time TIME,
-            stop_id TEXT,
-            stop_sequence TEXT,
-            PRIMARY KEY(trip_id, arrival_time)
-        )
-        """
+
+def cancel_imports():
+    """Cancel the parsing of GTFS data in worker processes.
+
+    Pending chunks are dropped and the workers exit once their current chunk
+    is parsed. Running imports fail without replacing the database.
+    """
+    global _import_executor
+    if _import_executor is not None:
+        _import_executor.shutdown(wait=False, cancel_futures=True)
+        _import_executor = None
+
+
+async def maintain_database(feed: Feed):
+    """Check the databases of a feed and compact them if needed.
+
+    A corrupted timetable database is rebuilt from the GTFS data. A new
+    timetable database is compacted once, which is left to this job instead
+    of the import to keep imports short.
+
+    Args:
+        feed (Feed): The feed to maintain.
+
+    Returns:
+        dict: Seconds spent on each step, or None if the feed has no database.
+
+    """
+    if not is_database_ready(feed):
+        return None
+    path = _get_dir_path(feed)
+    loop = asyncio.get_running_loop()
+    timings = {}
+    lock = _fetch_locks.setdefault(feed.feed_id, asyncio.Lock())
+    async with lock:  # Imports replace the same files
+        start = time.monotonic()
+        intact = await loop.run_in_executor(None, check_database, path)
+        timings["integrity_check"] = time.monotonic() - start
+        try:
+            meta = await _get_database_meta(feed)
+            if intact and meta.get("compacted") is None:
+                start = time.monotonic()
+                await loop.run_in_executor(None, compact_database, path)
+                timings["compact"] = time.monotonic() - start
+                _database_meta.pop(feed.feed_id, None)
+            if os.path.isfile(path + HISTORY_FILENAME):
+                start = time.monotonic()
+                await loop.run_in_executor(None, get_delay_history(feed).maintain)
+                timings["history"] = time.monotonic() - start
+        except (OSError, sqlite3.Error) as err:
+            _LOGGER.error("Error maintaining databases of %s: %s", feed.feed_id, err)
+    _LOGGER.info(
+        "Maintained databases of %s: %s",
+        feed.feed_id,
+        ", ".join(f"{step} {seconds:.2f} s" for step, seconds in timings.items()),
     )
-    to_db = [
-        (
-            i["trip_id"],
-            i["arrival_time"],
-            i["departure_time"],
-            i["stop_id"],
-            i["stop_sequence"],
+    if not intact:
+        _LOGGER.warning(
+            "Timetable database of %s is corrupted, importing GTFS data again",
+            feed.feed_id,
         )
-        for i in stop_times
-    ]
-    to_db.sort(key=lambda x: x[2])  # Sort by departure_time
-    cursor.executemany(
-        """
-        INSERT OR REPLACE INTO stop_times
-        (trip_id, arrival_time, departure_time, stop_id, stop_sequence)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        to_db,
-    )
-
-    conn.commit()
-    conn.close()
+        _database_meta[feed.feed_id] = {}  # Forces an import
+        start_gtfs_fetch(feed)
+    return timings
 
 
 def _format_datetime(dt):
@@ -236,60 +647,200 @@ def _format_datetime(dt):
 
 def _get_file_modified_time(file_path):
     dt = datetime(1970, 1, 1)
-    if os.path.isfile(file_path):
+    if file_path is not None and os.path.isfile(file_path):
         dt = datetime.fromtimestamp(os.path.getmtime(file_path), tz=UTC)
     return _format_datetime(dt)
 
 
-def _parse_csv_file(file_path):
-    with open(file_path, newline="", encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        return [row.copy() for row in reader]
-
-
-async def get_stops():
+async def get_stops(feed: Feed):
     """Get all the stops.
 
+    Args:
+        feed (Feed): The feed to get the stops from.
+
     Returns:
         list: A list of all stops.
 
     """
-    await _fetch_gtfs()
-    conn, cursor = _get_database()
-    cursor.execute("SELECT * FROM stops")
-    stops = cursor.fetchall()
-    conn.close()
-    return stops
+    return await _queries.run(("stops", feed.feed_id), _get_stops, feed)
+
+
+async def _get_stops(feed: Feed):
+    if not await _ensure_gtfs(feed):
+        return []
+    return await _run_query(feed, _query_stops)
+
 
+def _query_stops(cursor):
+    cursor.execute("SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops")
+    return cursor.fetchall()
 
-async def get_route_ids(stop_id):
+
+async def get_route_ids(feed: Feed, stop_id):
     """Get the route IDs for a given stop ID.
 
     Args:
+        feed (Feed): The feed the stop belongs to.
         stop_id (str): The ID of the stop.
 
     Returns:
         list: A list of route IDs associated with the stop.
 
     """
+    return await _queries.run(
+        ("route_ids", feed.feed_id, stop_id), _get_route_ids, feed, stop_id
+    )
+
+
+async def _get_route_ids(feed: Feed, stop_id):
+    if not await _ensure_gtfs(feed):
+        return []
+    return await _run_query(feed, _query_route_ids, stop_id)
+
 
-    await _fetch_gtfs()
-    conn, cursor = _get_database()
+def _query_route_ids(cursor, stop_id):
     cursor.execute(
         """
-        SELECT DISTINCT route_id
-        FROM trips
-        WHERE trip_id IN (
-            SELECT trip_id
-            FROM stop_times
-            WHERE stop_id = ?
-        )
+        SELECT routes.route_id FROM stop_routes
+        JOIN routes ON stop_routes.route_key = routes.route_key
+        WHERE stop_routes.stop_key = (SELECT stop_key FROM stops WHERE stop_id = ?)
+        ORDER BY routes.route_id
         """,
         (stop_id,),
     )
-    route_ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return route_ids
+    return [row[0] for row in cursor.fetchall()]
+
+
+async def get_stop_sequences(feed: Feed, stop_id, trip_ids):
+    """Get the position of a stop on each of the given trips.
+
+    Args:
+        feed (Feed): The feed the stop belongs to.
+        stop_id (str): The ID of the stop.
+        trip_ids (list): A list of trip IDs.
+
+    Returns:
+        dict: Stop sequences by trip ID. Trips not stopping at the stop are
+        left out.
+
+    """
+    if len(trip_ids) == 0 or not is_database_ready(feed):
+        return {}
+    return await _run_query(feed, _query_stop_sequences, stop_id, trip_ids)
+
+
+def _query_stop_sequences(cursor, stop_id, trip_ids):
+    cursor.execute("SELECT stop_key FROM stops WHERE stop_id = ?", (stop_id,))
+    stop = cursor.fetchone()
+    sequences = {}
+    if stop is None:
+        return sequences
+    for trip_id in trip_ids:
+        cursor.execute(
+            """
+            SELECT stop_sequence FROM stop_times
+            WHERE trip_key = (SELECT trip_key FROM trips WHERE trip_id = ?)
+            AND stop_key = ?
+            """,
+            (trip_id, stop[0]),
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            sequences[trip_id] = row[0]
+    return sequences
+
+
+# Straight-line distances are multiplied by this to estimate walking distances
+WALKING_DETOUR_FACTOR = 1.3
+# Walking speed in meters per second
+WALKING_SPEED = 1.4
+# Stops are searched within this many meters at most
+_MAX_SEARCH_RADIUS = 50000
+
+
+def _query_stops_within(cursor, spatial_index, latitude, longitude, radius):
+    delta_lat = radius / 111320
+    delta_lon = radius / (111320 * max(math.cos(math.radians(latitude)), 0.01))
+    box = (
+        latitude - delta_lat,
+        latitude + delta_lat,
+        longitude - delta_lon,
+        longitude + delta_lon,
+    )
+    if spatial_index:
+        cursor.execute(
+            """
+            SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops
+            WHERE stop_key IN (
+                SELECT id FROM stops_rtree
+                WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?
+            )
+            """,
+            box,
+        )
+    else:
+        cursor.execute(
+            """
+            SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops
+            WHERE stop_lat BETWEEN ? AND ? AND stop_lon BETWEEN ? AND ?
+            """,
+            box,
+        )
+    return cursor.fetchall()
+
+
+def _query_nearest_stops(cursor, spatial_index, latitude, longitude, amount):
+    radius = 500
+    while True:
+        rows = _query_stops_within(cursor, spatial_index, latitude, longitude, radius)
+        stops = sorted(
+            ((get_distance(latitude, longitude, row[2], row[3]), row) for row in rows),
+            key=lambda x: x[0],
+        )
+        # Stops in the corners of the area may be further than the radius
+        stops = [stop for stop in stops if stop[0] <= radius]
+        if len(stops) >= amount or radius >= _MAX_SEARCH_RADIUS:
+            return stops
+        radius *= 4
+
+
+async def get_nearest_stops(feed: Feed, latitude, longitude, amount):
+    """Get the stops nearest to the given coordinates.
+
+    Stops are searched with the spatial index in growing areas until enough
+    stops are found. Databases without the index are scanned instead.
+
+    Args:
+        feed (Feed): The feed to get the stops from.
+        latitude (float): Latitude of the location.
+        longitude (float): Longitude of the location.
+        amount (int): The maximum number of stops to return.
+
+    Returns:
+        list: Dictionaries with the stop ID and name, the straight-line
+        distance and estimated walking distance in meters, and the estimated
+        walking time in minutes, nearest first.
+
+    """
+    if not await _ensure_gtfs(feed):
+        return []
+    meta = await _get_database_meta(feed)
+    spatial_index = meta.get("spatial_index") == "rtree"
+    stops = await _run_query(
+        feed, _query_nearest_stops, spatial_index, latitude, longitude, amount
+    )
+    return [
+        {
+            "stop_id": row[0],
+            "stop_name": row[1],
+            "distance": round(distance),
+            "walking_distance": round(distance * WALKING_DETOUR_FACTOR),
+            "walking_time": math.ceil(
+                distance * WALKING_DETOUR_FACTOR / WALKING_SPEED / 60
+            ),
+        }
+        for distance, row in stops[:amount]
+    ]
 
 
 class StopTime(NamedTuple):
@@ -300,48 +851,82 @@ class StopTime(NamedTuple):
     delay: int | None
     delta_days: int
     realtime: bool
+    trip_id: str | None = None
+    stop_sequence: int | None = None
+    predicted: bool = False
 
 
-async def get_stop_times(stop_id, route_ids, amount, from_time):
-    """Get the stop times for a given stop ID, route IDs, and amount.
+async def _get_timetable(feed: Feed):
+    if feed.feed_id not in _compiled_feeds:
+        return None
+    if feed.feed_id not in _timetables:
+        # Lookups during loading wait for the validated timetable
+        _timetables[feed.feed_id] = await _queries.run(
+            ("timetable", feed.feed_id), _load_timetable, feed
+        )
+    return _timetables[feed.feed_id]
 
-    Args:
-        stop_id (str): The ID of the stop.
-        route_ids (list): A list of route IDs.
-        amount (int): The maximum number of stop times to retrieve.
-        from_time (datetime): The starting time to filter the stop times.
 
-    Returns:
-        list: A list of stop times.
+async def _load_timetable(feed: Feed):
+    if "compiled_timetable" not in await _get_database_meta(feed):
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        timetable = await loop.run_in_executor(
+            None, Timetable, _get_dir_path(feed) + TIMETABLE_FILENAME
+        )
+    except (OSError, ValueError) as err:
+        _LOGGER.warning("Failed to load compiled timetable: %s", err)
+        return None
+    if await _validate_timetable(feed, timetable, _pruned_stops.get(feed.feed_id)):
+        _LOGGER.warning(
+            "Compiled timetable of %s does not match the database, "
+            "using database queries instead",
+            feed.feed_id,
+        )
+        return None
+    return timetable
 
-    """
-    await _fetch_gtfs()
-    conn, cursor = _get_database()
-    today = datetime.now().strftime("%Y%m%d")
-    weekday = datetime.strptime(today, "%Y%m%d").strftime("%A").lower()
+
+def _query_stop_times(cursor, stop_id, route_ids, today, weekday, start_time, amount):
+    cursor.execute(
+        f"""
+        SELECT routes.route_id, headsigns.trip_headsign, stop_times.departure_time,
+            trips.trip_id, stop_times.stop_sequence
+        FROM stop_times
+        JOIN trips ON stop_times.trip_key = trips.trip_key
+        JOIN calendar ON trips.service_key = calendar.service_key
+        JOIN routes ON trips.route_key = routes.route_key
+        JOIN headsigns ON trips.headsign_key = headsigns.headsign_key
+        WHERE stop_times.stop_key = (SELECT stop_key FROM stops WHERE stop_id = ?)
+        AND trips.route_key IN (
+            SELECT route_key FROM routes
+            WHERE route_id IN ({",".join(["?"] * len(route_ids))})
+        )
+        AND calendar.{weekday} = '1'
+        AND calendar.start_date <= ?
+        AND calendar.end_date >= ?
+        AND stop_times.departure_time > ?
+        ORDER BY stop_times.departure_time, stop_times.trip_key
+        LIMIT ?
+        """,
+        [stop_id, *route_ids, today, today, start_time, amount],
+    )
+    return cursor.fetchall()
+
+
+def _collect_stop_times(get_rows, amount, from_time):
+    # Times are parsed as today's, so later service days are offset by days
+    service_day = from_time.date()
+    first_delta_days = (service_day - datetime.now().date()).days
+    today = service_day.strftime("%Y%m%d")
+    weekday = service_day.strftime("%A").lower()
     stop_times: list[StopTime] = []
-    delta_days = 0
+    delta_days = first_delta_days
     start_time = from_time.strftime("%H:%M:%S")
     while len(stop_times) < amount:
-        cursor.execute(
-            f"""
-            SELECT route_id, trip_headsign, departure_time
-            FROM stop_times
-            JOIN trips ON stop_times.trip_id = trips.trip_id
-            JOIN calendar ON trips.service_id = calendar.service_id
-            WHERE stop_id = ?
-            AND trips.route_id IN ({",".join(["?"] * len(route_ids))})
-            AND calendar.{weekday} = '1'
-            AND calendar.start_date <= ?
-            AND calendar.end_date >= ?
-            AND departure_time > ?
-            LIMIT ?
-            """,
-            [stop_id, *route_ids, today, today, start_time, amount],
-        )
-
-        for row in cursor.fetchall():
-            route_id, trip_headsign, departure_time_str = row
+        for row in get_rows(today, weekday, start_time, amount):
+            route_id, trip_headsign, departure_time_str, trip_id, stop_sequence = row
             row_delta_days = delta_days
             hours, minutes, seconds = map(int, departure_time_str.split(":"))
 
@@ -362,6 +947,8 @@ async def get_stop_times(stop_id, route_ids, amount, from_time):
                     None,
                     row_delta_days,
                     False,
+                    trip_id,
+                    stop_sequence,
                 )
             )
 
@@ -369,7 +956,7 @@ async def get_stop_times(stop_id, route_ids, amount, from_time):
             break
         # If there are no more stop times for today, move to the next day
         delta_days += 1
-        if delta_days == 7:
+        if delta_days - first_delta_days == 7:
             _LOGGER.debug(
                 "Not enough departures found. Consider decreasing the amount of requested departures"
             )
@@ -378,5 +965,359 @@ async def get_stop_times(stop_id, route_ids, amount, from_time):
         today = next_day.strftime("%Y%m%d")
         weekday = next_day.strftime("%A").lower()
         start_time = "00:00:00"
-    conn.close()
     return stop_times[:amount]
+
+
+async def get_stop_times(feed: Feed, stop_id, route_ids, amount, from_time):
+    """Get the stop times for a given stop ID, route IDs, and amount.
+
+    Uses the compiled timetable of the feed when it is enabled.
+
+    Args:
+        feed (Feed): The feed the stop belongs to.
+        stop_id (str): The ID of the stop.
+        route_ids (list): A list of route IDs.
+        amount (int): The maximum number of stop times to retrieve.
+        from_time (datetime): The starting time to filter the stop times.
+
+    Returns:
+        list: A list of stop times.
+
+    """
+    # Departures are listed with a precision of seconds
+    from_time = from_time.replace(microsecond=0)
+    return await _queries.run(
+        ("stop_times", feed.feed_id, stop_id, tuple(route_ids), amount, from_time),
+        _get_stop_times,
+        feed,
+        stop_id,
+        route_ids,
+        amount,
+        from_time,
+    )
+
+
+async def _get_stop_times(feed: Feed, stop_id, route_ids, amount, from_time):
+    if not await _ensure_gtfs(feed):
+        return []
+    timetable = await _get_timetable(feed)
+    if timetable is not None:
+        return _collect_stop_times(
+            lambda *args: timetable.get_departures(stop_id, route_ids, *args),
+            amount,
+            from_time,
+        )
+    return await _run_query(
+        feed,
+        lambda cursor: _collect_stop_times(
+            lambda *args: _query_stop_times(cursor, stop_id, route_ids, *args),
+            amount,
+            from_time,
+        ),
+    )
+
+
+async def _validate_timetable(feed: Feed, timetable: Timetable, stop_ids, amount=20):
+    return await _run_query(feed, _compare_stop_times, timetable, stop_ids, amount)
+
+
+def _compare_stop_times(cursor, timetable: Timetable, stop_ids, amount):
+    if stop_ids is None:
+        cursor.execute(
+            """
+            SELECT stop_id FROM stops
+            WHERE stop_key IN (SELECT stop_key FROM stop_routes)
+            LIMIT 10
+            """
+        )
+        stop_ids = [row[0] for row in cursor.fetchall()]
+    from_time = dt_util.now()
+    mismatches = []
+    for stop_id in stop_ids:
+        route_ids = _query_route_ids(cursor, stop_id)
+        compiled = _collect_stop_times(
+            lambda *args: timetable.get_departures(stop_id, route_ids, *args),
+            amount,
+            from_time,
+        )
+        queried = _collect_stop_times(
+            lambda *args: _query_stop_times(cursor, stop_id, route_ids, *args),
+            amount,
+            from_time,
+        )
+        if compiled != queried:
+            mismatches.append(stop_id)
+    return mismatches
+
+
+class Connection(NamedTuple):
+    route_id: str
+    trip_headsign: str
+    departure_time: datetime
+    arrival_time: datetime
+    trip_id: str
+
+
+# Connections of this many origin, destination and day combinations are cached
+_CONNECTION_CACHE_SIZE = 32
+
+
+def _query_connections(cursor, origin_id, destination_id, today, weekday):
+    cursor.execute(
+        f"""
+        SELECT routes.route_id, headsigns.trip_headsign, origin.departure_time,
+            destination.arrival_time, trips.trip_id
+        FROM stop_times AS origin
+        JOIN stop_times AS destination
+            ON destination.trip_key = origin.trip_key
+            AND destination.stop_key = (SELECT stop_key FROM stops WHERE stop_id = ?)
+            AND destination.stop_sequence > origin.stop_sequence
+        JOIN trips ON origin.trip_key = trips.trip_key
+        JOIN calendar ON trips.service_key = calendar.service_key
+        JOIN routes ON trips.route_key = routes.route_key
+        JOIN headsigns ON trips.headsign_key = headsigns.headsign_key
+        WHERE origin.stop_key = (SELECT stop_key FROM stops WHERE stop_id = ?)
+        AND calendar.{weekday} = '1'
+        AND calendar.start_date <= ?
+        AND calendar.end_date >= ?
+        ORDER BY origin.departure_time
+        """,
+        [destination_id, origin_id, today, today],
+    )
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+async def _get_day_connections(feed: Feed, origin_id, destination_id, today):
+    key = (feed.feed_id, origin_id, destination_id, today)
+    if key not in _connections:
+        weekday = datetime.strptime(today, "%Y%m%d").strftime("%A").lower()
+        rows = await _run_query(
+            feed, _query_connections, origin_id, destination_id, today, weekday
+        )
+        if len(_connections) >= _CONNECTION_CACHE_SIZE:
+            del _connections[next(iter(_connections))]
+        _connections[key] = rows
+    return _connections[key]
+
+
+def to_datetime(time_str, service_day):
+    """Convert a GTFS time of a service day to a local datetime.
+
+    Args:
+        time_str (str): The time as HH:MM:SS. Times after midnight are past
+            24:00:00 on the service day.
+        service_day (date): The service day the time belongs to.
+
+    Returns:
+        datetime: The local time.
+
+    """
+    hours, minutes, seconds = map(int, time_str.split(":"))
+    return dt_util.start_of_local_day(service_day) + timedelta(
+        hours=hours, minutes=minutes, seconds=seconds
+    )
+
+
+async def get_connections(feed: Feed, origin_id, destination_id, amount, from_time):
+    """Get the next direct trips from one stop to another.
+
+    All trips of a service day are queried at once and cached, so later
+    lookups on the same day do not touch the database.
+
+    Args:
+        feed (Feed): The feed the stops belong to.
+        origin_id (str): The ID of the stop to depart from.
+        destination_id (str): The ID of the stop to arrive at.
+        amount (int): The maximum number of connections to retrieve.
+        from_time (datetime): Only connections departing after this time are
+            returned.
+
+    Returns:
+        list: A list of connections.
+
+    """
+    if not await _ensure_gtfs(feed):
+        return []
+    from_time = dt_util.as_local(from_time)
+    start_time = from_time.strftime("%H:%M:%S")
+    connections: list[Connection] = []
+    for delta_days in range(7):
+        service_day = from_time.date() + timedelta(days=delta_days)
+        today = service_day.strftime("%Y%m%d")
+        rows = await _get_day_connections(feed, origin_id, destination_id, today)
+        start = bisect.bisect_right(rows, start_time, key=lambda row: row[2])
+        for route_id, trip_headsign, departure_time, arrival_time, trip_id in rows[
+            start : start + amount - len(connections)
+        ]:
+            connections.append(
+                Connection(
+                    route_id,
+                    trip_headsign,
+                    to_datetime(departure_time, service_day),
+                    to_datetime(arrival_time, service_day),
+                    trip_id,
+                )
+            )
+        if len(connections) >= amount:
+            break
+        start_time = "00:00:00"
+    return connections
+
+
+class TripStop(NamedTuple):
+    stop_id: str
+    stop_name: str
+    stop_sequence: int
+    arrival_time: str
+    departure_time: str
+
+
+class Trip(NamedTuple):
+    trip_id: str
+    route_id: str
+    trip_headsign: str
+    stops: tuple[TripStop, ...]
+
+
+# Trips and stop patterns cached at most, the least recently used are dropped
+_TRIP_CACHE_SIZE = 256
+_TRIP_PATTERN_CACHE_SIZE = 64
+
+
+def _get_cached_lru(cache, key):
+    value = cache.pop(key, None)
+    if value is not None:
+        cache[key] = value  # Move to the end as the most recently used
+    return value
+
+
+def _set_cached_lru(cache, key, value, size):
+    if len(cache) >= size:
+        del cache[next(iter(cache))]
+    cache[key] = value
+
+
+def _query_trip(cursor, trip_id):
+    cursor.execute(
+        """
+        SELECT trips.trip_key, routes.route_id, headsigns.trip_headsign
+        FROM trips
+        JOIN routes ON trips.route_key = routes.route_key
+        JOIN headsigns ON trips.headsign_key = headsigns.headsign_key
+        WHERE trips.trip_id = ?
+        """,
+        (trip_id,),
+    )
+    trip = cursor.fetchone()
+    if trip is None:
+        return None
+    # Read in order from the primary key of stop_times
+    cursor.execute(
+        """
+        SELECT stop_key, stop_sequence, arrival_time, departure_time
+        FROM stop_times WHERE trip_key = ?
+        ORDER BY stop_sequence
+        """,
+        (trip[0],),
+    )
+    rows = cursor.fetchall()
+    return (
+        trip[1],
+        trip[2],
+        tuple(row[0] for row in rows),
+        tuple(tuple(row[1:]) for row in rows),
+    )
+
+
+def _query_trip_pattern(cursor, stop_keys):
+    cursor.execute(
+        f"""
+        SELECT stop_key, stop_id, stop_name FROM stops
+        WHERE stop_key IN ({",".join(["?"] * len(stop_keys))})
+        """,
+        stop_keys,
+    )
+    stops = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+    return tuple(stops[stop_key] for stop_key in stop_keys)
+
+
+async def get_trip(feed: Feed, trip_id):
+    """Get the stops of a trip in order.
+
+    Trips are cached, and trips calling at the same stops in the same order
+    share one decoded list of stop IDs and names, so repeated lookups of a
+    trip or of other trips of the same route do not touch the database.
+
+    Args:
+        feed (Feed): The feed the trip belongs to.
+        trip_id (str): The ID of the trip.
+
+    Returns:
+        Trip: The trip, or None if the feed has no such trip.
+
+    """
+    return await _queries.run(("trip", feed.feed_id, trip_id), _get_trip, feed, trip_id)
+
+
+async def _get_trip(feed: Feed, trip_id):
+    if not await _ensure_gtfs(feed):
+        return None
+    key = (feed.feed_id, trip_id)
+    trip = _get_cached_lru(_trips, key)
+    if trip is None:
+        row = await _run_query(feed, _query_trip, trip_id)
+        if row is None:
+            return None
+        route_id, trip_headsign, stop_keys, times = row
+        pattern_key = (feed.feed_id, stop_keys)
+        pattern = _get_cached_lru(_trip_patterns, pattern_key)
+        if pattern is None:
+            pattern = await _run_query(feed, _query_trip_pattern, stop_keys)
+            _set_cached_lru(
+                _trip_patterns, pattern_key, pattern, _TRIP_PATTERN_CACHE_SIZE
+            )
+        trip = (route_id, trip_headsign, pattern, times)
+        _set_cached_lru(_trips, key, trip, _TRIP_CACHE_SIZE)
+    route_id, trip_headsign, pattern, times = trip
+    return Trip(
+        trip_id,
+        route_id,
+        trip_headsign,
+        tuple(
+            TripStop(*stop, *stop_times)
+            for stop, stop_times in zip(pattern, times, strict=True)
+        ),
+    )
+
+
+def get_remaining_stops(trip: Trip, stop_sequence, departure_time):
+    """Get the stops of a trip after a stop with their estimated arrival times.
+
+    Arrival times are offset from the departure from the given stop, so a
+    delay included in the departure time carries over to the later stops.
+
+    Args:
+        trip (Trip): The trip.
+        stop_sequence (int): Position of the stop departed from on the trip.
+        departure_time (datetime): Departure time from the stop.
+
+    Returns:
+        list: (TripStop, datetime) tuples of the later stops.
+
+    """
+    origin = next(
+        (stop for stop in trip.stops if stop.stop_sequence == stop_sequence), None
+    )
+    if origin is None:
+        return []
+    service_day = departure_time.date()
+    origin_time = to_datetime(origin.departure_time, service_day)
+    return [
+        (
+            stop,
+            departure_time
+            + (to_datetime(stop.arrival_time, service_day) - origin_time),
+        )
+        for stop in trip.stops
+        if stop.stop_sequence > stop_sequence
+    ]
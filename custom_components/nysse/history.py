@@ -0,0 +1,257 @@
+"""Stores observed delays and maintains delay statistics."""
+
+from datetime import datetime, timedelta
+import json
+import math
+import sqlite3
+import threading
+import time
+
+HISTORY_FILENAME = "history.db"
+# Observations older than this are removed from the history and statistics
+RETENTION = timedelta(days=28)
+
+# Delays are counted in buckets of this many seconds for percentiles
+BUCKET_SIZE = 30
+MIN_DELAY = -300
+MAX_DELAY = 1800
+_BUCKET_COUNT = (MAX_DELAY - MIN_DELAY) // BUCKET_SIZE
+
+
+def _get_bucket(delay):
+    index = (delay - MIN_DELAY) // BUCKET_SIZE
+    return min(max(index, 0), _BUCKET_COUNT - 1)
+
+
+def _get_percentile(histogram, count, percentile):
+    # The upper bound of the bucket containing the percentile
+    target = math.ceil(count * percentile / 100)
+    cumulative = 0
+    for index, bucket_count in enumerate(histogram):
+        cumulative += bucket_count
+        if cumulative >= target:
+            return MIN_DELAY + (index + 1) * BUCKET_SIZE
+    return MAX_DELAY
+
+
+def get_hour_of_week(departure_time: datetime):
+    """Get the hour of the week of a departure, starting from Monday 00-01."""
+    return departure_time.weekday() * 24 + departure_time.hour
+
+
+class DelayHistory:
+    """Delay observations of a feed with running statistics.
+
+    Statistics are kept per stop, route and hour of the week, and updated on
+    every insert and expiry so that reading them never scans the history.
+    Methods do blocking I/O and should be run in an executor.
+    """
+
+    def __init__(self, file_path, retention=RETENTION) -> None:
+        """Initialize the history."""
+        self._file_path = file_path
+        self._retention = retention
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self._file_path)
+        # Commits only append to the write-ahead log, which is synced at
+        # checkpoints, so frequent small updates cause few writes to storage
+        conn.execute("PRAGMA synchronous = NORMAL")
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS observations (
+                    observed_at REAL,
+                    stop_id TEXT,
+                    route_id TEXT,
+                    hour_of_week INTEGER,
+                    delay INTEGER
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS observations_observed_at
+                ON observations (observed_at)
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS delay_statistics (
+                    stop_id TEXT,
+                    route_id TEXT,
+                    hour_of_week INTEGER,
+                    count INTEGER,
+                    mean REAL,
+                    m2 REAL,
+                    histogram TEXT,
+                    PRIMARY KEY(stop_id, route_id, hour_of_week)
+                ) WITHOUT ROWID
+                """
+            )
+            self._initialized = True
+        return conn
+
+    def _update_statistics(self, cursor, key, delay, removed=False):
+        cursor.execute(
+            """
+            SELECT count, mean, m2, histogram FROM delay_statistics
+            WHERE stop_id = ? AND route_id = ? AND hour_of_week = ?
+            """,
+            key,
+        )
+        row = cursor.fetchone()
+        if row is None:
+            if removed:
+                return
+            count, mean, m2, histogram = 0, 0.0, 0.0, [0] * _BUCKET_COUNT
+        else:
+            count, mean, m2 = row[0], row[1], row[2]
+            histogram = json.loads(row[3])
+
+        # Welford's algorithm, run backwards for removed observations
+        if removed:
+            count -= 1
+            if count == 0:
+                mean, m2 = 0.0, 0.0
+            else:
+                old_mean = mean
+                mean = (old_mean * (count + 1) - delay) / count
+                m2 = max(m2 - (delay - mean) * (delay - old_mean), 0.0)
+            histogram[_get_bucket(delay)] -= 1
+        else:
+            count += 1
+            old_mean = mean
+            mean += (delay - old_mean) / count
+            m2 += (delay - old_mean) * (delay - mean)
+            histogram[_get_bucket(delay)] += 1
+
+        if count == 0:
+            cursor.execute(
+                """
+                DELETE FROM delay_statistics
+                WHERE stop_id = ? AND route_id = ? AND hour_of_week = ?
+                """,
+                key,
+            )
+            return
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO delay_statistics
+            (stop_id, route_id, hour_of_week, count, mean, m2, histogram)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (*key, count, mean, m2, json.dumps(histogram)),
+        )
+
+    def _expire(self, cursor, now):
+        cursor.execute(
+            """
+            SELECT stop_id, route_id, hour_of_week, delay FROM observations
+            WHERE observed_at < ?
+            """,
+            (now - self._retention.total_seconds(),),
+        )
+        for row in cursor.fetchall():
+            self._update_statistics(cursor, row[:3], row[3], removed=True)
+        cursor.execute(
+            "DELETE FROM observations WHERE observed_at < ?",
+            (now - self._retention.total_seconds(),),
+        )
+
+    def record(self, observations):
+        """Record final delays of departures.
+
+        Args:
+            observations (list): Tuples of stop ID, route ID, aimed departure
+                time and delay in seconds.
+
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                cursor = conn.cursor()
+                for stop_id, route_id, departure_time, delay in observations:
+                    hour_of_week = get_hour_of_week(departure_time)
+                    cursor.execute(
+                        """
+                        INSERT INTO observations
+                        (observed_at, stop_id, route_id, hour_of_week, delay)
+                        VALUES (?, ?, ?, ?, ?)
+                        """,
+                        (now, stop_id, route_id, hour_of_week, delay),
+                    )
+                    self._update_statistics(
+                        cursor, (stop_id, route_id, hour_of_week), delay
+                    )
+                self._expire(cursor, now)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def get_statistics(self, stop_id, route_ids=None, hour_of_week=None):
+        """Get delay statistics of a stop.
+
+        Args:
+            stop_id (str): The ID of the stop.
+            route_ids (list): Only include these routes. Defaults to all routes.
+            hour_of_week (int): Only include this hour of the week. Defaults
+                to all hours.
+
+        Returns:
+            list: Dictionaries with the route ID, hour of the week, number of
+            observations, and the mean, standard deviation, median and 90th
+            percentile of the delay in seconds.
+
+        """
+        query = "SELECT * FROM delay_statistics WHERE stop_id = ?"
+        params = [stop_id]
+        if route_ids is not None:
+            query += f" AND route_id IN ({','.join(['?'] * len(route_ids))})"
+            params.extend(route_ids)
+        if hour_of_week is not None:
+            query += " AND hour_of_week = ?"
+            params.append(hour_of_week)
+        with self._lock:
+            conn = self._connect()
+            try:
+                rows = conn.execute(query, params).fetchall()
+            finally:
+                conn.close()
+
+        statistics = []
+        for _, route_id, row_hour_of_week, count, mean, m2, histogram in rows:
+            histogram = json.loads(histogram)
+            statistics.append(
+                {
+                    "line": route_id,
+                    "hour_of_week": row_hour_of_week,
+                    "count": count,
+                    "mean": round(mean),
+                    "stdev": round(math.sqrt(m2 / count)),
+                    "p50": _get_percentile(histogram, count, 50),
+                    "p90": _get_percentile(histogram, count, 90),
+                }
+            )
+        return statistics
+
+    def maintain(self):
+        """Refresh query planner statistics and compact the history.
+
+        The file is only compacted when expired observations have left a
+        large part of it unused.
+        """
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute("PRAGMA optimize")
+                (page_count,) = conn.execute("PRAGMA page_count").fetchone()
+                (free_count,) = conn.execute("PRAGMA freelist_count").fetchone()
+                if free_count * 4 > page_count:
+                    conn.execute("VACUUM")
+            finally:
+                conn.close()
@@ -0,0 +1,503 @@
+"""Imports GTFS data to the timetable database."""
+
+from concurrent import futures
+import csv
+import io
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+
+from .timetable import TIMETABLE_FILENAME, TIMETABLE_VERSION, write_timetable
+
+_LOGGER = logging.getLogger(__name__)
+
+# Bumped whenever the database layout changes to force a reimport
+SCHEMA_VERSION = 7
+
+# Large tables are split into chunks of roughly this many bytes
+CHUNK_SIZE = 4 * 1024 * 1024
+
+STOP_COLUMNS = ("stop_id", "stop_name", "stop_lat", "stop_lon")
+TRIP_COLUMNS = ("trip_id", "route_id", "service_id", "trip_headsign", "direction_id")
+CALENDAR_COLUMNS = (
+    "service_id",
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+    "start_date",
+    "end_date",
+)
+# The database is built into a temporary file which is discarded if the import
+# fails, so it is written without a journal or intermediate syncs
+_IMPORT_PRAGMAS = (
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -32768",
+    "PRAGMA temp_store = MEMORY",
+)
+
+STOP_TIME_COLUMNS = (
+    "trip_id",
+    "arrival_time",
+    "departure_time",
+    "stop_id",
+    "stop_sequence",
+)
+
+
+def _get_chunks(file_path):
+    """Split a CSV file into byte ranges that start at the beginning of a row.
+
+    GTFS tables do not contain line breaks inside fields, so rows can be found
+    by searching for line breaks.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        header_line = f.readline()
+        start = f.tell()
+        chunks = []
+        while start < size:
+            f.seek(min(start + CHUNK_SIZE, size))
+            f.readline()  # Move to the end of the current row
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
+    header = next(csv.reader([header_line.decode("utf-8-sig")]))
+    return [column.strip() for column in header], chunks
+
+
+def _parse_csv_chunk(file_path, start, end, indices):
+    """Parse rows between the given byte offsets into tuples.
+
+    Only the columns at the given indices are kept. Missing columns are None.
+    Runs in a worker process.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start).decode("utf-8")
+    rows = []
+    for row in csv.reader(io.StringIO(data, newline="")):
+        if not row:
+            continue
+        rows.append(
+            tuple(row[i] if i is not None and i < len(row) else None for i in indices)
+        )
+    return rows
+
+
+def _parse_csv_file(executor, file_path, columns):
+    header, chunks = _get_chunks(file_path)
+    indices = [header.index(column) if column in header else None for column in columns]
+    try:
+        jobs = [
+            executor.submit(_parse_csv_chunk, file_path, start, end, indices)
+            for start, end in chunks
+        ]
+    except RuntimeError as err:
+        # The executor was shut down while the import was running
+        raise futures.CancelledError from err
+    rows = []
+    for job in jobs:
+        rows.extend(job.result())
+    return rows
+
+
+def _to_float(value):
+    if not value:
+        return None
+    return float(value)
+
+
+def _parse_stop_times(rows, path):
+    stop_times = []
+    for trip_id, arrival_time, departure_time, stop_id, stop_sequence in rows:
+        try:
+            stop_sequence = int(stop_sequence)
+        except (TypeError, ValueError):
+            continue  # A malformed row does not abort the import
+        stop_times.append(
+            (trip_id, arrival_time, departure_time, stop_id, stop_sequence)
+        )
+    if len(stop_times) < len(rows):
+        _LOGGER.warning(
+            "Skipped %s stop times without a valid stop sequence in %s",
+            len(rows) - len(stop_times),
+            path,
+        )
+    return stop_times
+
+
+def _sync_file(file_path):
+    # Make sure a file written without syncs is on disk before it replaces
+    # the previous one
+    with open(file_path, "r+b") as f:
+        os.fsync(f.fileno())
+
+
+def _encode(keys, value):
+    """Get the integer key of a string, adding a new key if needed."""
+    return keys.setdefault(value, len(keys) + 1)
+
+
+def import_csv_files(path, pruned_stops, compile_timetable, executor):
+    """Import extracted GTFS files to the timetable database.
+
+    Tables are parsed in chunks in the given executor while the calling thread
+    writes the results. The database is built into a separate file which
+    replaces the previous database once complete.
+
+    Args:
+        path (str): Directory containing the GTFS files and the database.
+        pruned_stops (set): IDs of the stops to import trips for, or None to
+            import all trips.
+        compile_timetable (bool): Whether to also write a compiled timetable.
+        executor (concurrent.futures.Executor): Executor for parsing chunks,
+            typically a process pool.
+
+    Returns:
+        dict: Metadata stored to the database.
+
+    """
+    stops = [
+        (stop_id, stop_name, _to_float(stop_lat), _to_float(stop_lon))
+        for stop_id, stop_name, stop_lat, stop_lon in (
+            _parse_csv_file(executor, path + "stops.txt", STOP_COLUMNS)
+        )
+    ]
+    trips = _parse_csv_file(executor, path + "trips.txt", TRIP_COLUMNS)
+    calendar = _parse_csv_file(executor, path + "calendar.txt", CALENDAR_COLUMNS)
+    stop_times = _parse_stop_times(
+        _parse_csv_file(executor, path + "stop_times.txt", STOP_TIME_COLUMNS), path
+    )
+    _LOGGER.debug("Parsed %s stop times from %s", len(stop_times), path)
+
+    # Lines serving each stop are needed for configuring any stop, so they are
+    # stored before the timetable is pruned
+    route_ids = {i[0]: i[1] for i in trips}
+    stop_routes = {(i[3], route_ids[i[0]]) for i in stop_times}
+
+    meta = {"schema_version": str(SCHEMA_VERSION)}
+    if os.path.isfile(path + "feed_info.txt"):
+        feed_info = _parse_csv_file(executor, path + "feed_info.txt", ("feed_version",))
+        if len(feed_info) > 0 and feed_info[0][0]:
+            meta["feed_version"] = feed_info[0][0]
+    if pruned_stops is not None:
+        trip_ids = {i[0] for i in stop_times if i[3] in pruned_stops}
+        stop_times = [i for i in stop_times if i[0] in trip_ids]
+        trips = [i for i in trips if i[0] in trip_ids]
+        service_ids = {i[2] for i in trips}
+        calendar = [i for i in calendar if i[0] in service_ids]
+        meta["pruned_stops"] = json.dumps(sorted(pruned_stops))
+        _LOGGER.debug("Pruning timetable to %s trips", len(trip_ids))
+
+    # Strings are stored once and referred to by integer keys elsewhere, which
+    # keeps the large tables and their indexes small
+    stops = list({stop[0]: stop for stop in stops}.values())
+    stop_keys = {stop[0]: key for key, stop in enumerate(stops, 1)}
+    service_keys = {row[0]: key for key, row in enumerate(calendar, 1)}
+    route_keys = {}
+    headsign_keys = {}
+    trip_keys = {}
+    encoded_trips = []
+    for trip_id, route_id, service_id, trip_headsign, direction_id in trips:
+        if trip_id in trip_keys:
+            continue
+        trip_keys[trip_id] = len(trip_keys) + 1
+        encoded_trips.append(
+            (
+                trip_keys[trip_id],
+                trip_id,
+                _encode(route_keys, route_id),
+                service_keys.get(service_id),
+                _encode(headsign_keys, trip_headsign),
+                direction_id,
+            )
+        )
+    encoded_stop_times = [
+        (
+            trip_keys[trip_id],
+            stop_sequence,
+            _encode(stop_keys, stop_id),
+            arrival_time,
+            departure_time,
+        )
+        for trip_id, arrival_time, departure_time, stop_id, stop_sequence in (
+            stop_times
+        )
+        if trip_id in trip_keys
+    ]
+    encoded_stop_routes = {
+        (_encode(stop_keys, stop_id), _encode(route_keys, route_id))
+        for stop_id, route_id in stop_routes
+    }
+
+    # Build into a separate file so queries keep using the old timetable
+    # until the new one is complete
+    tmp_path = path + "database.db.tmp"
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    cursor = conn.cursor()
+    for pragma in _IMPORT_PRAGMAS:
+        cursor.execute(pragma)
+
+    # Stops
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stops (
+            stop_key INTEGER PRIMARY KEY,
+            stop_id TEXT UNIQUE,
+            stop_name TEXT,
+            stop_lat REAL,
+            stop_lon REAL
+        )
+        """
+    )
+    cursor.executemany(
+        """
+        INSERT INTO stops (stop_key, stop_id, stop_name, stop_lat, stop_lon)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [(stop_keys[stop[0]], *stop) for stop in stops],
+    )
+
+    # Routes and headsigns
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS routes (
+            route_key INTEGER PRIMARY KEY,
+            route_id TEXT UNIQUE
+        )
+        """
+    )
+    cursor.executemany(
+        "INSERT INTO routes (route_key, route_id) VALUES (?, ?)",
+        [(key, route_id) for route_id, key in route_keys.items()],
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS headsigns (
+            headsign_key INTEGER PRIMARY KEY,
+            trip_headsign TEXT
+        )
+        """
+    )
+    cursor.executemany(
+        "INSERT INTO headsigns (headsign_key, trip_headsign) VALUES (?, ?)",
+        [(key, trip_headsign) for trip_headsign, key in headsign_keys.items()],
+    )
+
+    # Trips
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS trips (
+            trip_key INTEGER PRIMARY KEY,
+            trip_id TEXT UNIQUE,
+            route_key INTEGER,
+            service_key INTEGER,
+            headsign_key INTEGER,
+            direction_id TEXT
+        )
+        """
+    )
+    cursor.executemany(
+        """
+        INSERT INTO trips
+        (trip_key, trip_id, route_key, service_key, headsign_key, direction_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        encoded_trips,
+    )
+
+    # Calendar
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS calendar (
+            service_key INTEGER PRIMARY KEY,
+            service_id TEXT UNIQUE,
+            monday TEXT,
+            tuesday TEXT,
+            wednesday TEXT,
+            thursday TEXT,
+            friday TEXT,
+            saturday TEXT,
+            sunday TEXT,
+            start_date TEXT,
+            end_date TEXT
+        )
+        """
+    )
+    cursor.executemany(
+        """
+        INSERT OR REPLACE INTO calendar
+        (service_key, service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday, start_date, end_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [(service_keys[row[0]], *row) for row in calendar],
+    )
+
+    # Stop times are clustered by trip, so the stops of a trip are read in order
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stop_times (
+            trip_key INTEGER,
+            stop_sequence INTEGER,
+            stop_key INTEGER,
+            arrival_time TIME,
+            departure_time TIME,
+            PRIMARY KEY(trip_key, stop_sequence)
+        ) WITHOUT ROWID
+        """
+    )
+    encoded_stop_times.sort(key=lambda x: x[:2])  # Insert in primary key order
+    cursor.executemany(
+        """
+        INSERT OR REPLACE INTO stop_times
+        (trip_key, stop_sequence, stop_key, arrival_time, departure_time)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        encoded_stop_times,
+    )
+    # Departures of a stop are read in order of departure
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS stop_times_stop_departure
+        ON stop_times (stop_key, departure_time)
+        """
+    )
+    # Positions of a stop on a trip, the index also holds the stop sequence
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS stop_times_trip_stop
+        ON stop_times (trip_key, stop_key)
+        """
+    )
+
+    # Stop routes
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stop_routes (
+            stop_key INTEGER,
+            route_key INTEGER,
+            PRIMARY KEY(stop_key, route_key)
+        ) WITHOUT ROWID
+        """
+    )
+    cursor.executemany(
+        "INSERT INTO stop_routes (stop_key, route_key) VALUES (?, ?)",
+        sorted(encoded_stop_routes),
+    )
+
+    # Spatial index of stops, if SQLite is built with the R*Tree module
+    try:
+        cursor.execute(
+            """
+            CREATE VIRTUAL TABLE stops_rtree USING rtree(
+                id, min_lat, max_lat, min_lon, max_lon
+            )
+            """
+        )
+        cursor.execute(
+            """
+            INSERT INTO stops_rtree
+            SELECT stop_key, stop_lat, stop_lat, stop_lon, stop_lon FROM stops
+            WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL
+            """
+        )
+        meta["spatial_index"] = "rtree"
+    except sqlite3.OperationalError as err:
+        _LOGGER.debug("Spatial index not available: %s", err)
+
+    # Compiled timetable
+    if compile_timetable:
+        try:
+            write_timetable(path + TIMETABLE_FILENAME, stop_times, trips, calendar)
+            meta["compiled_timetable"] = str(TIMETABLE_VERSION)
+        except ValueError as err:
+            _LOGGER.warning("Failed to compile timetable: %s", err)
+    elif os.path.isfile(path + TIMETABLE_FILENAME):
+        os.remove(path + TIMETABLE_FILENAME)
+
+    # Metadata
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        """
+    )
+    cursor.executemany(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", meta.items()
+    )
+
+    # Statistics for the query planner
+    cursor.execute("ANALYZE")
+
+    conn.commit()
+    conn.close()
+    _sync_file(tmp_path)
+    os.replace(tmp_path, path + "database.db")
+    _LOGGER.debug("Imported GTFS data to %s", path + "database.db")
+    return meta
+
+
+def check_database(path):
+    """Check the integrity of the timetable database.
+
+    Args:
+        path (str): Directory containing the database.
+
+    Returns:
+        bool: True if the database is intact.
+
+    """
+    conn = None
+    try:
+        # Read-only, so a missing database is not created
+        uri = pathlib.Path(path + "database.db").as_uri()
+        conn = sqlite3.connect(uri + "?mode=ro", uri=True)
+        result = conn.execute("PRAGMA integrity_check").fetchall()
+    except sqlite3.Error as err:
+        _LOGGER.debug("Integrity check of %s failed: %s", path, err)
+        return False
+    finally:
+        if conn is not None:
+            conn.close()
+    return result == [("ok",)]
+
+
+def compact_database(path):
+    """Rewrite the timetable database with its tables stored contiguously.
+
+    The compacted database is written into a separate file which replaces
+    the previous database, so queries in progress are not affected.
+
+    Args:
+        path (str): Directory containing the database.
+
+    """
+    tmp_path = path + "database.db.tmp"
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(path + "database.db")
+    try:
+        conn.execute("VACUUM INTO ?", (tmp_path,))
+    finally:
+        conn.close()
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('compacted', '1')"
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    _sync_file(tmp_path)
+    os.replace(tmp_path, path + "database.db")
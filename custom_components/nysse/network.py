@@ -1,15 +1,37 @@
+import asyncio
 import logging
+import time
+from typing import NamedTuple
+from urllib.parse import urlsplit
 
 import aiohttp
 
+from .cache import SingleFlight
+
 REQUEST_TIMEOUT = 30
+# Time an update waits for a response before serving cached data
+LATENCY_BUDGET = 5
+# Cached responses younger than this are served without a request
+CACHE_MAX_AGE = 15
+# Cached responses older than this are not served at all
+STALE_MAX_AGE = 600
+# Consecutive failures after which requests to an endpoint are paused
+FAILURE_THRESHOLD = 3
+CIRCUIT_OPEN_TIME = 60
+# Requests in progress at the same time at most
+MAX_CONCURRENT_REQUESTS = 4
 _LOGGER = logging.getLogger(__name__)
 
 
-async def get(url):
-    """Http GET helper."""
+_request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+
+async def _get(url):
     timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    async with (
+        _request_semaphore,
+        aiohttp.ClientSession(timeout=timeout) as session,
+    ):
         try:
             async with session.get(
                 url, headers={"Accept": "application/json"}
@@ -17,6 +39,137 @@ async def get(url):
                 if response.status == 200:
                     return await response.text()
                 _LOGGER.debug("Incorrect status for GET %s: %s", url, response.status)
+                # Server errors are failures, other statuses are valid answers
+                # such as an unknown stop
+                if response.status >= 500:
+                    response.raise_for_status()
                 return
         except aiohttp.ClientConnectorError as err:
             _LOGGER.error("Network connection error: %s", err)
+            raise
+
+
+_requests = SingleFlight()
+
+
+async def get(url):
+    """Http GET helper.
+
+    Concurrent requests for the same URL share one response, which is also
+    reused for a few seconds.
+    """
+    return await _requests.run(url, _get, url)
+
+
+class CachedResponse(NamedTuple):
+    data: str | None
+    age: float | None
+    fresh: bool
+
+
+class CircuitBreaker:
+    """Pauses requests to an endpoint after consecutive failures."""
+
+    def __init__(self, threshold, open_time) -> None:
+        """Initialize the circuit breaker."""
+        self._threshold = threshold
+        self._open_time = open_time
+        self._failures = 0
+        self._opened_at = None
+
+    def allow_request(self):
+        """Check whether a request may be made.
+
+        After the open time has passed a request is allowed again, and its
+        result decides whether the circuit closes or stays open.
+        """
+        if self._opened_at is None:
+            return True
+        return time.monotonic() - self._opened_at >= self._open_time
+
+    def record_success(self):
+        """Close the circuit after a successful request."""
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        """Open the circuit once enough requests have failed in a row."""
+        self._failures += 1
+        if self._failures >= self._threshold:
+            if self._opened_at is None:
+                _LOGGER.warning(
+                    "Pausing requests for %s seconds after %s failures",
+                    self._open_time,
+                    self._failures,
+                )
+            self._opened_at = time.monotonic()
+
+
+_cache: dict[str, tuple[str, float]] = {}
+_revalidations: dict[str, asyncio.Task] = {}
+_circuit_breakers: dict[str, CircuitBreaker] = {}
+
+
+def _get_circuit_breaker(url):
+    # Feeds of one host fail independently, e.g. the stop monitoring API can
+    # be down while the GTFS-RT feeds work. Stops share their endpoint.
+    parts = urlsplit(url)
+    endpoint = f"{parts.scheme}://{parts.netloc}{parts.path}"
+    if endpoint not in _circuit_breakers:
+        _circuit_breakers[endpoint] = CircuitBreaker(
+            FAILURE_THRESHOLD, CIRCUIT_OPEN_TIME
+        )
+    return _circuit_breakers[endpoint]
+
+
+async def _revalidate(url):
+    circuit_breaker = _get_circuit_breaker(url)
+    try:
+        data = await get(url)
+    except (aiohttp.ClientError, TimeoutError) as err:
+        _LOGGER.debug("Failed to fetch %s: %s", url, err)
+        circuit_breaker.record_failure()
+        return
+    # The endpoint answered even if there was no data to cache
+    circuit_breaker.record_success()
+    if data:
+        _cache[url] = (data, time.monotonic())
+
+
+async def get_cached(url, max_age=CACHE_MAX_AGE, budget=LATENCY_BUDGET):
+    """Http GET helper serving cached responses while revalidating.
+
+    Fresh cached responses are returned without a request. Otherwise the
+    response is fetched in the background, and if it does not arrive within
+    the latency budget the last good response is returned instead. Requests
+    are skipped while the endpoint is failing.
+
+    Args:
+        url (str): The URL to fetch.
+        max_age (float): Seconds a cached response is considered fresh.
+        budget (float): Seconds to wait for a new response.
+
+    Returns:
+        CachedResponse: The response body, its age in seconds and whether it
+        is fresh. The body is None if there is no usable response.
+
+    """
+    cached = _cache.get(url)
+    if cached is not None and time.monotonic() - cached[1] < max_age:
+        return CachedResponse(cached[0], time.monotonic() - cached[1], True)
+
+    if _get_circuit_breaker(url).allow_request():
+        task = _revalidations.get(url)
+        if task is None or task.done():
+            task = asyncio.create_task(_revalidate(url))
+            _revalidations[url] = task
+        try:
+            await asyncio.wait_for(asyncio.shield(task), budget)
+        except TimeoutError:
+            _LOGGER.debug("Serving cached response while revalidating %s", url)
+
+    cached = _cache.get(url)
+    if cached is None or time.monotonic() - cached[1] >= STALE_MAX_AGE:
+        return CachedResponse(None, None, False)
+    age = time.monotonic() - cached[1]
+    return CachedResponse(cached[0], age, age < max_age)
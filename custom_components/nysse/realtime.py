@@ -0,0 +1,104 @@
+"""Predicts delays of scheduled departures from realtime data."""
+
+import bisect
+import json
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# Parsed trip updates of the latest response of each feed
+_trip_updates: dict[str, tuple[str, dict[str, tuple[list[int], list[int]]]]] = {}
+
+
+def _get_delay(stop_time_update):
+    for event in ("departure", "arrival"):
+        delay = stop_time_update.get(event, {}).get("delay")
+        if delay is not None:
+            return int(delay)
+    return None
+
+
+def parse_trip_updates(url, data):
+    """Parse a GTFS-RT trip updates response into delays by trip.
+
+    The latest response of each URL is parsed only once, so sensors sharing
+    a cached response also share the parsed delays.
+
+    Args:
+        url (str): The URL the response was fetched from.
+        data (str): The response body in JSON format.
+
+    Returns:
+        dict: Sorted stop sequences and the delays at them, by trip ID.
+
+    """
+    parsed = _trip_updates.get(url)
+    if parsed is not None and parsed[0] is data:
+        return parsed[1]
+
+    delays = {}
+    try:
+        for entity in json.loads(data).get("entity", []):
+            trip_update = entity.get("trip_update")
+            if trip_update is None:
+                continue
+            updates = []
+            for stop_time_update in trip_update.get("stop_time_update", []):
+                delay = _get_delay(stop_time_update)
+                if delay is not None and "stop_sequence" in stop_time_update:
+                    updates.append((int(stop_time_update["stop_sequence"]), delay))
+            if len(updates) > 0:
+                updates.sort()
+                delays[trip_update["trip"]["trip_id"]] = (
+                    [update[0] for update in updates],
+                    [update[1] for update in updates],
+                )
+    except (KeyError, TypeError, ValueError) as err:
+        _LOGGER.info("Failed to process trip updates: %s", err)
+    _trip_updates[url] = (data, delays)
+    return delays
+
+
+def get_trip_delay(delays, trip_id, stop_sequence):
+    """Get the delay of a trip at a stop.
+
+    Delays propagate downstream, so the delay at the nearest stop at or
+    before the given stop is used.
+
+    Args:
+        delays (dict): Delays by trip ID from parse_trip_updates.
+        trip_id (str): The ID of the trip.
+        stop_sequence (int): Position of the stop on the trip.
+
+    Returns:
+        int: The delay in seconds, or None if the trip has no delay reported
+        at or before the stop.
+
+    """
+    trip_delays = delays.get(trip_id)
+    if trip_delays is None or stop_sequence is None:
+        return None
+    index = bisect.bisect_right(trip_delays[0], stop_sequence)
+    if index == 0:
+        return None
+    return trip_delays[1][index - 1]
+
+
+def get_line_delays(departures):
+    """Get the average delay of each line from realtime departures.
+
+    Args:
+        departures (list): Realtime departures as StopTime tuples.
+
+    Returns:
+        dict: Average delays in seconds by route ID.
+
+    """
+    line_delays = {}
+    for departure in departures:
+        if departure.delay is not None:
+            line_delays.setdefault(departure.route_id, []).append(departure.delay)
+    return {
+        route_id: round(sum(delays) / len(delays))
+        for route_id, delays in line_delays.items()
+    }
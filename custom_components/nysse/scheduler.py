@@ -0,0 +1,107 @@
+"""Spreads periodic entity updates evenly over the update interval."""
+
+from __future__ import annotations
+
+import asyncio
+from datetime import timedelta
+import random
+
+from homeassistant import core
+from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.event import async_call_later
+
+from .const import DOMAIN
+
+DATA_SCHEDULER = f"{DOMAIN}_scheduler"
+UPDATE_INTERVAL = timedelta(seconds=30)
+# Each gap between updates varies randomly by this fraction
+JITTER = 0.2
+
+
+class UpdateScheduler:
+    """Updates entities one at a time in turn.
+
+    The gap between updates is the interval divided by the number of
+    entities, so each entity is still updated once per interval on average
+    while the updates of different entities never fire together.
+    """
+
+    def __init__(self, hass: core.HomeAssistant, interval=UPDATE_INTERVAL) -> None:
+        """Initialize the scheduler."""
+        self._hass = hass
+        self._interval = interval.total_seconds()
+        self._entities: list[Entity] = []
+        self._next = 0
+        self._tasks: dict[Entity, asyncio.Task] = {}
+        self._cancel_timer: core.CALLBACK_TYPE | None = None
+
+    @core.callback
+    def async_add(self, entity: Entity) -> core.CALLBACK_TYPE:
+        """Start updating an entity.
+
+        The entity is placed last in turn, since it is updated when added.
+
+        Returns:
+            Callable: Stops updating the entity.
+
+        """
+        self._entities.insert(self._next, entity)
+        self._next += 1
+        if self._cancel_timer is None:
+            self._schedule_next()
+
+        @core.callback
+        def remove() -> None:
+            if self._entities.index(entity) < self._next:
+                self._next -= 1
+            self._entities.remove(entity)
+            self._tasks.pop(entity, None)
+            if len(self._entities) == 0 and self._cancel_timer is not None:
+                self._cancel_timer()
+                self._cancel_timer = None
+
+        return remove
+
+    @core.callback
+    def _schedule_next(self) -> None:
+        gap = self._interval / len(self._entities)
+        self._cancel_timer = async_call_later(
+            self._hass,
+            gap * random.uniform(1 - JITTER, 1 + JITTER),
+            self._async_update_next,
+        )
+
+    @core.callback
+    def _async_update_next(self, now) -> None:
+        self._cancel_timer = None
+        if len(self._entities) == 0:
+            return
+        self._next %= len(self._entities)
+        entity = self._entities[self._next]
+        self._next += 1
+        task = self._tasks.get(entity)
+        # An entity still waiting for its previous update skips its turn
+        if task is None or task.done():
+            self._tasks[entity] = self._hass.async_create_task(
+                entity.async_update_ha_state(True)
+            )
+        self._schedule_next()
+
+
+@core.callback
+def async_schedule_updates(
+    hass: core.HomeAssistant, entity: Entity
+) -> core.CALLBACK_TYPE:
+    """Update an entity periodically, spread out from other entities.
+
+    Args:
+        hass (HomeAssistant): Home Assistant instance.
+        entity (Entity): The entity to update. It should not be polled.
+
+    Returns:
+        Callable: Stops updating the entity.
+
+    """
+    if DATA_SCHEDULER not in hass.data:
+        hass.data[DATA_SCHEDULER] = UpdateScheduler(hass)
+    return hass.data[DATA_SCHEDULER].async_add(entity)
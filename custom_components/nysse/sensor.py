@@ -5,10 +5,7 @@ from __future__ import annotations
 from datetime import timedelta
 import json
 import logging
-
-from dateutil import parser
-from dateutil.parser import ParserError
-import isodate
+import sqlite3
 
 from homeassistant import config_entries, core
 from homeassistant.components.sensor import SensorEntity
@@ -16,20 +13,50 @@ from homeassistant.helpers.entity_platform import AddEntitiesCallback
 import homeassistant.util.dt as dt_util
 
 from .const import (
+    CONF_DESTINATION,
+    CONF_FEED,
+    CONF_HISTORY,
+    CONF_ORIGIN,
+    CONF_TRIP_STOPS,
+    DEFAULT_FEED,
+    DEFAULT_HISTORY,
     DEFAULT_ICON,
     DEFAULT_MAX,
     DEFAULT_TIMELIMIT,
+    DEFAULT_TRIP_STOPS,
     DOMAIN,
     PLATFORM_NAME,
-    SERVICE_ALERTS_URL,
-    STOP_URL,
     TRAM_LINES,
 )
-from .fetch_api import StopTime, get_stop_times, get_stops
-from .network import get
+from .departures import (
+    format_departure,
+    get_departure_time,
+    parse_departures,
+    predict_delays,
+    remove_realtime_journeys,
+)
+from .fetch_api import (
+    Connection,
+    Feed,
+    StopTime,
+    get_connections,
+    get_delay_history,
+    get_feed,
+    get_feed_version,
+    get_remaining_stops,
+    get_stop_times,
+    get_stops,
+    get_trip,
+    is_database_ready,
+    start_gtfs_fetch,
+)
+from .history import get_hour_of_week
+from .network import get_cached
+from .scheduler import async_schedule_updates
+from .snapshot import DATA_SNAPSHOT
+from .websocket import async_publish_departures
 
 _LOGGER = logging.getLogger(__name__)
-SCAN_INTERVAL = timedelta(seconds=30)
 
 
 async def async_setup_entry(
@@ -39,39 +66,91 @@ async def async_setup_entry(
 ) -> None:
     """Setups sensors from a config entry created in the integrations UI."""
     sensors = []
-    configs = hass.data[DOMAIN]
-    if len(configs) > 0:
-        if config_entry.entry_id == next(iter(configs)):
-            sensors.append(ServiceAlertSensor())
-
-    if "station" in config_entry.options:
+    feed_config = config_entry.data.get(CONF_FEED, DEFAULT_FEED)
+    feed = get_feed(feed_config)
+
+    # Service alerts are added by the first entry of each feed
+    feed_entries = [
+        entry_id
+        for entry_id, config in hass.data[DOMAIN].items()
+        if config.get(CONF_FEED, DEFAULT_FEED) == feed_config
+    ]
+    if feed.service_alerts_url is not None and len(feed_entries) > 0:
+        if config_entry.entry_id == feed_entries[0]:
+            sensors.append(ServiceAlertSensor(feed))
+
+    if CONF_ORIGIN in config_entry.data:
+        sensors.append(
+            ConnectionSensor(
+                feed,
+                config_entry.data[CONF_ORIGIN],
+                config_entry.data[CONF_DESTINATION],
+                config_entry.options.get(
+                    "max", config_entry.data.get("max", DEFAULT_MAX)
+                ),
+                config_entry.title,
+            )
+        )
+    elif "station" in config_entry.options:
         sensors.append(
             NysseSensor(
+                feed,
                 config_entry.options["station"],
                 config_entry.options.get("max", DEFAULT_MAX),
                 config_entry.options.get("timelimit", DEFAULT_TIMELIMIT),
                 config_entry.options["lines"],
+                config_entry.title,
+                config_entry.options.get(CONF_HISTORY, DEFAULT_HISTORY),
+                config_entry.options.get(CONF_TRIP_STOPS, DEFAULT_TRIP_STOPS),
             )
         )
     else:
         sensors.append(
             NysseSensor(
+                feed,
                 config_entry.data["station"],
                 config_entry.data.get("max", DEFAULT_MAX),
                 config_entry.data.get("timelimit", DEFAULT_TIMELIMIT),
                 config_entry.data["lines"],
+                config_entry.title,
+                config_entry.data.get(CONF_HISTORY, DEFAULT_HISTORY),
+                config_entry.data.get(CONF_TRIP_STOPS, DEFAULT_TRIP_STOPS),
             )
         )
 
-    async_add_entities(sensors, update_before_add=True)
+    # Departures from before a restart are shown until the first update
+    snapshot = hass.data[DATA_SNAPSHOT]
+    for sensor in sensors:
+        if isinstance(sensor, NysseSensor):
+            sensor.restore_snapshot(
+                snapshot.get(sensor.unique_id), get_feed_version(feed)
+            )
+
+    # Entities are updated once added so that fetching GTFS data does not
+    # block the setup
+    async_add_entities(sensors)
 
 
 class NysseSensor(SensorEntity):
     """Representation of a Sensor."""
 
-    def __init__(self, stop_code, maximum, timelimit, lines) -> None:
+    _attr_should_poll = False
+
+    def __init__(
+        self,
+        feed: Feed,
+        stop_code,
+        maximum,
+        timelimit,
+        lines,
+        title,
+        history,
+        trip_stops,
+    ) -> None:
         """Initialize the sensor."""
+        self._feed = feed
         self._stop_code = stop_code
+        self._title = title
         self._max_items = int(maximum)
         self._timelimit = int(timelimit)
         self._lines = lines
@@ -79,8 +158,101 @@ class NysseSensor(SensorEntity):
         self._journeys = []
         self._stops = []
         self._all_data = []
+        self._trip_stops = trip_stops
+        self._remaining_stops = {}
 
         self._last_update_time = None
+        self._realtime_status = None
+        self._realtime_age = None
+
+        self._history = get_delay_history(feed) if history else None
+        self._observed_departures = {}
+        self._delay_statistics = None
+        self._restored_station_name = None
+
+    async def async_added_to_hass(self) -> None:
+        """Update the sensor now and periodically after that."""
+        self.async_schedule_update_ha_state(True)
+        self.async_on_remove(async_schedule_updates(self.hass, self))
+
+    def restore_snapshot(self, data, feed_version):
+        """Restore departures saved before a restart.
+
+        Departures that have already left are dropped. Snapshots of another
+        version of the GTFS data are ignored.
+
+        Args:
+            data (dict): The saved snapshot, or None.
+            feed_version (str): Version of the imported GTFS data, or None if
+                unknown.
+
+        """
+        if data is None:
+            return
+        if feed_version is not None and data.get("feed_version") != feed_version:
+            return
+        try:
+            now = dt_util.now()
+            stop_times = [
+                StopTime(
+                    item["route_id"],
+                    item["trip_headsign"],
+                    dt_util.parse_datetime(item["departure_time"]),
+                    dt_util.parse_datetime(item["aimed_departure_time"])
+                    if item["aimed_departure_time"] is not None
+                    else None,
+                    item["delay"],
+                    0,
+                    item["realtime"],
+                    item["trip_id"],
+                    item["stop_sequence"],
+                    item["predicted"],
+                )
+                for item in data["departures"]
+            ]
+            stop_times = [
+                stop_time
+                for stop_time in stop_times
+                if stop_time.departure_time >= now + timedelta(minutes=self._timelimit)
+            ]
+            # Times to station are counted from now, not from the saved update
+            self._last_update_time = now
+            self._all_data = self._data_to_display_format(stop_times[: self._max_items])
+            self._last_update_time = dt_util.parse_datetime(data["last_refresh"])
+            self._restored_station_name = data["station_name"]
+        except (KeyError, TypeError, ValueError) as err:
+            _LOGGER.debug("%s: Failed to restore departures: %s", self._stop_code, err)
+
+    def _save_snapshot(self, stop_times: list[StopTime]):
+        departures = []
+        for stop_time in stop_times:
+            departure_time = stop_time.departure_time + timedelta(
+                days=stop_time.delta_days
+            )
+            departures.append(
+                {
+                    "route_id": stop_time.route_id,
+                    "trip_headsign": stop_time.trip_headsign,
+                    "departure_time": departure_time.isoformat(),
+                    "aimed_departure_time": stop_time.aimed_departure_time.isoformat()
+                    if stop_time.aimed_departure_time is not None
+                    else None,
+                    "delay": stop_time.delay,
+                    "realtime": stop_time.realtime,
+                    "trip_id": stop_time.trip_id,
+                    "stop_sequence": stop_time.stop_sequence,
+                    "predicted": stop_time.predicted,
+                }
+            )
+        self.hass.data[DATA_SNAPSHOT].async_set(
+            self.unique_id,
+            {
+                "feed_version": get_feed_version(self._feed),
+                "last_refresh": self._last_update_time.isoformat(),
+                "station_name": self._get_station_name(),
+                "departures": departures,
+            },
+        )
 
     def _remove_unwanted_departures(self, departures: list[StopTime]):
         try:
@@ -114,95 +286,130 @@ class NysseSensor(SensorEntity):
             return []
 
     async def _fetch_departures(self):
+        if self._feed.stop_url is None:
+            return []  # Feed has no realtime data
         try:
-            url = STOP_URL.format(self._stop_code)
+            url = self._feed.stop_url.format(self._stop_code)
             _LOGGER.debug(
                 "%s: Fectching departures from %s",
                 self._stop_code,
                 url + "&indent=yes",
             )
-            data = await get(url)
-            if not data:
+            response = await get_cached(url)
+            if response.data is None:
+                self._realtime_status = "unavailable"
+                self._realtime_age = None
                 _LOGGER.warning(
                     "%s: Nysse API error: failed to fetch realtime data: no data received from %s",
                     self._stop_code,
                     url,
                 )
                 return None
-            unformatted_departures = json.loads(data)
-            return self._format_departures(unformatted_departures)
+            self._realtime_status = "fresh" if response.fresh else "stale"
+            self._realtime_age = int(response.age)
+            return parse_departures(
+                json.loads(response.data), self._stop_code, self._get_stop_name
+            )
         except OSError as err:
             _LOGGER.error("%s: Failed to fetch realtime data: %s", self._stop_code, err)
             return []
 
-    def _format_departures(self, departures):
-        try:
-            body = departures["body"][self._stop_code]
-            formatted_data: list[StopTime] = []
-            for departure in body:
-                try:
-                    formatted_departure = StopTime(
-                        departure["lineRef"],
-                        self._get_stop_name(departure["destinationShortName"]),
-                        parser.parse(departure["call"]["expectedDepartureTime"]),
-                        parser.parse(departure["call"]["aimedDepartureTime"]),
-                        self._delay_to_display_format(departure["delay"]),
-                        0,
-                        True,
-                    )
-                    formatted_data.append(formatted_departure)
-                except (KeyError, ParserError) as err:
-                    _LOGGER.info(
-                        "%s: Failed to process realtime departure: %s",
-                        self._stop_code,
-                        err,
-                    )
+    async def _record_delays(self, departures: list[StopTime]):
+        # The last delay seen before a departure disappears from the realtime
+        # data is recorded as its final delay. Departures missing from a stale
+        # or empty response, or missing before their aimed departure time, may
+        # still reappear and are kept.
+        finished = []
+        if self._realtime_status == "fresh" and len(departures) > 0:
+            observed_departures = {
+                (departure.route_id, departure.aimed_departure_time): departure
+                for departure in departures
+            }
+            for key, departure in self._observed_departures.items():
+                if key in observed_departures:
                     continue
-            return formatted_data
-        except KeyError as err:
-            _LOGGER.info(
-                "%s: Nysse API error: failed to process realtime data: %s",
+                if departure.aimed_departure_time > self._last_update_time:
+                    observed_departures[key] = departure
+                elif departure.delay is not None:
+                    finished.append(
+                        (
+                            self._stop_code,
+                            departure.route_id,
+                            dt_util.as_local(departure.aimed_departure_time),
+                            departure.delay,
+                        )
+                    )
+            self._observed_departures = observed_departures
+        try:
+            if len(finished) > 0:
+                await self.hass.async_add_executor_job(self._history.record, finished)
+            self._delay_statistics = await self.hass.async_add_executor_job(
+                self._history.get_statistics,
                 self._stop_code,
-                err,
+                self._lines,
+                get_hour_of_week(self._last_update_time),
             )
-            return []
-        except OSError as err:
-            _LOGGER.info(
-                "%s: failed to process realtime data: %s",
-                self._stop_code,
-                err,
+        except sqlite3.Error as err:
+            _LOGGER.warning(
+                "%s: Failed to update delay history: %s", self._stop_code, err
             )
-            return []
 
     async def async_update(self) -> None:
         """Fetch new state data for the sensor."""
         try:
             self._last_update_time = dt_util.now()
 
-            if len(self._stops) == 0:
+            database_ready = is_database_ready(self._feed)
+            if not database_ready:
+                # Serve realtime departures until the timetable is imported
+                _LOGGER.debug("%s: Waiting for GTFS data", self._stop_code)
+                start_gtfs_fetch(self._feed)
+            elif len(self._stops) == 0:
                 _LOGGER.debug("Getting stops")
-                self._stops = await get_stops()
+                self._stops = await get_stops(self._feed)
 
             departures = await self._fetch_departures()
+            if self._history is not None and departures is not None:
+                await self._record_delays(departures)
             departures = self._remove_unwanted_departures(departures)
-            if len(departures) < self._max_items:
-                self._journeys = await get_stop_times(
+            if not database_ready:
+                self._journeys = []
+            elif len(departures) < self._max_items or self._trip_stops:
+                # Scheduled departures also tell the trips of realtime departures
+                journeys = await get_stop_times(
+                    self._feed,
                     self._stop_code,
                     self._lines,
                     self._max_items,
                     self._last_update_time + timedelta(minutes=self._timelimit),
                 )
-                for journey in self._journeys[:]:
-                    for departure in departures:
-                        if (
-                            journey.departure_time == departure.aimed_departure_time
-                            and journey.route_id == departure.route_id
-                        ):
-                            self._journeys.remove(journey)
+                departures, journeys = remove_realtime_journeys(journeys, departures)
+                if len(departures) < self._max_items:
+                    self._journeys = await predict_delays(
+                        self.hass,
+                        self._feed,
+                        journeys,
+                        departures,
+                        self._last_update_time,
+                        self._delay_statistics,
+                    )
+                else:
+                    self._journeys.clear()
             else:
                 self._journeys.clear()
+            if self._trip_stops:
+                self._remaining_stops = await self._get_remaining_stops(
+                    departures + self._journeys
+                )
 
             self._all_data = self._data_to_display_format(departures + self._journeys)
+            self._save_snapshot(departures + self._journeys)
+            async_publish_departures(
+                self.hass,
+                self._feed.feed_id,
+                self._stop_code,
+                departures + self._journeys,
+            )
 
             _LOGGER.debug(
                 "%s: Got %s valid departures and %s valid journeys",
@@ -213,62 +420,40 @@ class NysseSensor(SensorEntity):
         except (OSError, ValueError) as err:
             _LOGGER.error("%s: Failed to update sensor: %s", self._stop_code, err)
 
+    async def _get_remaining_stops(self, journeys: list[StopTime]):
+        # Realtime departures without a scheduled departure have no known trip
+        remaining_stops = {}
+        for journey in journeys:
+            if journey.trip_id is None:
+                continue
+            trip = await get_trip(self._feed, journey.trip_id)
+            if trip is None:
+                continue
+            remaining_stops[journey.trip_id] = [
+                {
+                    "stop_id": stop.stop_id,
+                    "stop_name": stop.stop_name,
+                    "arrival": arrival_time.strftime("%H:%M"),
+                }
+                for stop, arrival_time in get_remaining_stops(
+                    trip, journey.stop_sequence, get_departure_time(journey)
+                )
+            ]
+        return remaining_stops
+
     def _data_to_display_format(self, data: list[StopTime]):
         try:
             formatted_data = []
             for item in data:
-                departure = {
-                    "destination": item.trip_headsign,
-                    "line": item.route_id,
-                    "departure": item.departure_time.strftime("%H:%M"),
-                    "time_to_station": self._time_to_station(item),
-                    "icon": self._get_line_icon(item.route_id),
-                    "realtime": item.realtime,
-                }
-                if item.aimed_departure_time is not None:
-                    departure["aimed_departure"] = item.aimed_departure_time.strftime(
-                        "%H:%M"
-                    )
-                if item.delay is not None:
-                    departure["delay"] = item.delay
+                departure = format_departure(item, self._last_update_time)
+                if item.trip_id in self._remaining_stops:
+                    departure["stops"] = self._remaining_stops[item.trip_id]
                 formatted_data.append(departure)
             return sorted(formatted_data, key=lambda x: x["time_to_station"])
         except (OSError, ValueError) as err:
             _LOGGER.debug("%s: Failed to format data:  %s", self._stop_code, err)
             return []
 
-    def _get_line_icon(self, line_no):
-        if line_no in TRAM_LINES:
-            return "mdi:tram"
-        return "mdi:bus"
-
-    def _time_to_station(self, item: StopTime):
-        try:
-            departure_local = dt_util.as_local(item.departure_time)
-            if item.delta_days > 0:
-                departure_local += timedelta(days=item.delta_days)
-            next_departure_time = (departure_local - self._last_update_time).seconds
-            return int(next_departure_time / 60)
-        except OSError as err:
-            _LOGGER.debug(
-                "%s: Failed to calculate time to station: %s",
-                self._stop_code,
-                err,
-            )
-            return 0
-
-    def _delay_to_display_format(self, item):
-        try:
-            delay = isodate.parse_duration(item)
-            return int(delay.total_seconds())
-        except (OSError, ValueError) as err:
-            _LOGGER.debug(
-                "%s: Failed to format delay: %s",
-                self._stop_code,
-                err,
-            )
-            return 0
-
     def _get_stop_name(self, stop_id):
         try:
             return next(
@@ -287,14 +472,24 @@ class NysseSensor(SensorEntity):
             )
             return "unknown stop"
 
+    def _get_station_name(self):
+        if len(self._stops) == 0 and self._restored_station_name is not None:
+            return self._restored_station_name
+        return self._get_stop_name(self._stop_code)
+
     @property
     def unique_id(self) -> str:
         """Unique id for the sensor."""
-        return PLATFORM_NAME + "_" + self._stop_code
+        if self._feed.feed_id == DEFAULT_FEED:
+            return PLATFORM_NAME + "_" + self._stop_code
+        return PLATFORM_NAME + "_" + self._feed.feed_id + "_" + self._stop_code
 
     @property
     def name(self) -> str:
         """Return the name of the sensor."""
+        if len(self._stops) == 0:
+            # Stops are loaded on the first update, use the name given in setup
+            return self._title
         stop_name = self._get_stop_name(self._stop_code)
         return f"{stop_name} ({self._stop_code})"
 
@@ -308,28 +503,149 @@ class NysseSensor(SensorEntity):
         """Return the state of the sensor."""
         if len(self._all_data) > 0:
             return self._all_data[0]["departure"]
+        if not is_database_ready(self._feed):
+            return "initializing"
         return "unknown"
 
     @property
     def extra_state_attributes(self):
         """Sensor attributes."""
-        return {
+        attributes = {
             "last_refresh": self._last_update_time,
             "departures": self._all_data,
-            "station_name": self._get_stop_name(self._stop_code),
+            "station_name": self._get_station_name(),
             "station_id": self._stop_code,
+            "realtime_status": self._realtime_status,
+            "realtime_age": self._realtime_age,
+        }
+        if self._history is not None:
+            attributes["delay_statistics"] = self._delay_statistics
+        return attributes
+
+
+class ConnectionSensor(SensorEntity):
+    """Representation of a sensor for direct trips between two stops."""
+
+    _attr_should_poll = False
+
+    def __init__(self, feed: Feed, origin_id, destination_id, maximum, title) -> None:
+        """Initialize the sensor."""
+        self._feed = feed
+        self._origin_id = origin_id
+        self._destination_id = destination_id
+        self._max_items = int(maximum)
+        self._title = title
+
+        self._connections: list[Connection] = []
+        self._stops = {}
+        self._last_update_time = None
+
+    async def async_added_to_hass(self) -> None:
+        """Update the sensor now and periodically after that."""
+        self.async_schedule_update_ha_state(True)
+        self.async_on_remove(async_schedule_updates(self.hass, self))
+
+    async def async_update(self) -> None:
+        """Fetch new state data for the sensor."""
+        self._last_update_time = dt_util.now()
+        if not is_database_ready(self._feed):
+            _LOGGER.debug("%s: Waiting for GTFS data", self.unique_id)
+            start_gtfs_fetch(self._feed)
+            return
+        if len(self._stops) == 0:
+            self._stops = {
+                stop["stop_id"]: stop["stop_name"]
+                for stop in await get_stops(self._feed)
+            }
+        self._connections = await get_connections(
+            self._feed,
+            self._origin_id,
+            self._destination_id,
+            self._max_items,
+            self._last_update_time,
+        )
+
+    def _connection_to_display_format(self, connection: Connection):
+        return {
+            "line": connection.route_id,
+            "destination": connection.trip_headsign,
+            "departure": connection.departure_time.strftime("%H:%M"),
+            "arrival": connection.arrival_time.strftime("%H:%M"),
+            "duration": int(
+                (connection.arrival_time - connection.departure_time).total_seconds()
+                / 60
+            ),
+            "time_to_station": int(
+                (connection.departure_time - self._last_update_time).total_seconds()
+                / 60
+            ),
+            "icon": "mdi:tram" if connection.route_id in TRAM_LINES else "mdi:bus",
+        }
+
+    @property
+    def unique_id(self) -> str:
+        """Unique id for the sensor."""
+        connection = f"connection_{self._origin_id}_{self._destination_id}"
+        if self._feed.feed_id == DEFAULT_FEED:
+            return PLATFORM_NAME + "_" + connection
+        return PLATFORM_NAME + "_" + self._feed.feed_id + "_" + connection
+
+    @property
+    def name(self) -> str:
+        """Return the name of the sensor."""
+        if len(self._stops) == 0:
+            return self._title
+        origin = self._stops.get(self._origin_id, self._origin_id)
+        destination = self._stops.get(self._destination_id, self._destination_id)
+        return f"{origin} → {destination}"
+
+    @property
+    def icon(self) -> str:
+        """Icon of the sensor."""
+        return "mdi:bus-marker"
+
+    @property
+    def state(self) -> str:
+        """Return the state of the sensor."""
+        if len(self._connections) > 0:
+            return self._connections[0].departure_time.strftime("%H:%M")
+        if not is_database_ready(self._feed):
+            return "initializing"
+        return "unknown"
+
+    @property
+    def extra_state_attributes(self):
+        """Sensor attributes."""
+        return {
+            "last_refresh": self._last_update_time,
+            "connections": [
+                self._connection_to_display_format(connection)
+                for connection in self._connections
+            ],
+            "origin_name": self._stops.get(self._origin_id),
+            "origin_id": self._origin_id,
+            "destination_name": self._stops.get(self._destination_id),
+            "destination_id": self._destination_id,
         }
 
 
 class ServiceAlertSensor(SensorEntity):
     """Representation of a service alert sensor."""
 
-    def __init__(self) -> None:
+    _attr_should_poll = False
+
+    def __init__(self, feed: Feed) -> None:
         """Initialize the sensor."""
+        self._feed = feed
         self._last_update = ""
         self._alerts = []
         self._empty_response_counter = 0
 
+    async def async_added_to_hass(self) -> None:
+        """Update the sensor now and periodically after that."""
+        self.async_schedule_update_ha_state(True)
+        self.async_on_remove(async_schedule_updates(self.hass, self))
+
     def _timestamp_to_local(self, timestamp):
         try:
             utc = dt_util.utc_from_timestamp(int(str(timestamp)[:10]))
@@ -347,11 +663,11 @@ class ServiceAlertSensor(SensorEntity):
     async def _fetch_service_alerts(self):
         try:
             alerts = []
-            data = await get(SERVICE_ALERTS_URL)
+            data = (await get_cached(self._feed.service_alerts_url)).data
             if not data:
                 _LOGGER.warning(
                     "Nysse API error: failed to fetch service alerts: no data received from %s",
-                    SERVICE_ALERTS_URL,
+                    self._feed.service_alerts_url,
                 )
                 return None
             json_data = json.loads(data)
@@ -395,12 +711,16 @@ class ServiceAlertSensor(SensorEntity):
     @property
     def unique_id(self) -> str:
         """Unique id for the sensor."""
-        return "service_alerts"
+        if self._feed.feed_id == DEFAULT_FEED:
+            return "service_alerts"
+        return "service_alerts_" + self._feed.feed_id
 
     @property
     def name(self) -> str:
         """Return the name of the sensor."""
-        return "Nysse Service Alerts"
+        if self._feed.feed_id == DEFAULT_FEED:
+            return "Nysse Service Alerts"
+        return f"Nysse Service Alerts ({self._feed.feed_id})"
 
     @property
     def icon(self) -> str:
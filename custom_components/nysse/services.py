@@ -0,0 +1,347 @@
+"""Services of the Nysse integration."""
+
+from __future__ import annotations
+
+from datetime import timedelta
+import json
+import sqlite3
+
+import voluptuous as vol
+
+from homeassistant import core
+from homeassistant.const import CONF_LATITUDE, CONF_LONGITUDE
+from homeassistant.exceptions import HomeAssistantError, ServiceValidationError
+import homeassistant.helpers.config_validation as cv
+import homeassistant.util.dt as dt_util
+
+from .cache import SingleFlight
+from .const import CONF_FEED, DEFAULT_FEED, DOMAIN
+from .departures import (
+    format_departure,
+    get_departure_time,
+    parse_departures,
+    predict_delays,
+    remove_realtime_journeys,
+)
+from .fetch_api import (
+    Feed,
+    async_load_feed,
+    get_delay_history,
+    get_feed,
+    get_nearest_stops,
+    get_route_ids,
+    get_stop_times,
+    get_stops,
+    get_trip,
+    is_database_ready,
+    start_gtfs_fetch,
+    to_datetime,
+)
+from .network import get_cached
+from .realtime import get_trip_delay, parse_trip_updates
+
+SERVICE_GET_DELAY_STATISTICS = "get_delay_statistics"
+SERVICE_FIND_NEAREST_STOPS = "find_nearest_stops"
+SERVICE_GET_TRIP = "get_trip"
+SERVICE_GET_DEPARTURES = "get_departures"
+
+ATTR_STOP_ID = "stop_id"
+ATTR_LINES = "lines"
+ATTR_HOUR_OF_WEEK = "hour_of_week"
+ATTR_COUNT = "count"
+ATTR_TRIP_ID = "trip_id"
+ATTR_OFFSET = "offset"
+ATTR_DURATION = "duration"
+
+# Departure lookups with the same arguments share results for this many seconds
+DEPARTURES_TTL = 10
+_departure_lookups = SingleFlight(DEPARTURES_TTL)
+
+GET_DELAY_STATISTICS_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_FEED, default=DEFAULT_FEED): cv.string,
+        vol.Required(ATTR_STOP_ID): cv.string,
+        vol.Optional(ATTR_LINES): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(ATTR_HOUR_OF_WEEK): vol.All(
+            vol.Coerce(int), vol.Range(min=0, max=167)
+        ),
+    }
+)
+
+FIND_NEAREST_STOPS_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_FEED, default=DEFAULT_FEED): cv.string,
+        vol.Inclusive(CONF_LATITUDE, "coordinates"): cv.latitude,
+        vol.Inclusive(CONF_LONGITUDE, "coordinates"): cv.longitude,
+        vol.Optional(ATTR_COUNT, default=5): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=50)
+        ),
+    }
+)
+
+GET_TRIP_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_FEED, default=DEFAULT_FEED): cv.string,
+        vol.Required(ATTR_TRIP_ID): cv.string,
+        vol.Optional(ATTR_STOP_ID): cv.string,
+    }
+)
+
+GET_DEPARTURES_SCHEMA = vol.Schema(
+    {
+        vol.Optional(CONF_FEED, default=DEFAULT_FEED): cv.string,
+        vol.Required(ATTR_STOP_ID): cv.string,
+        vol.Optional(ATTR_LINES): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(ATTR_OFFSET, default=0): vol.All(
+            vol.Coerce(int), vol.Range(min=0, max=1440)
+        ),
+        vol.Optional(ATTR_DURATION, default=60): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=1440)
+        ),
+        vol.Optional(ATTR_COUNT, default=10): vol.All(
+            vol.Coerce(int), vol.Range(min=1, max=50)
+        ),
+    }
+)
+
+
+def _get_configured_feed(hass: core.HomeAssistant, call: core.ServiceCall) -> Feed:
+    # Other feeds would be downloaded and imported just for the call
+    feed_id = call.data[CONF_FEED]
+    configured_feeds = {
+        config.get(CONF_FEED, DEFAULT_FEED) for config in hass.data[DOMAIN].values()
+    }
+    if feed_id not in configured_feeds:
+        raise ServiceValidationError(f"Feed {feed_id} is not configured")
+    return get_feed(feed_id)
+
+
+async def _async_get_delay_statistics(
+    hass: core.HomeAssistant, call: core.ServiceCall
+) -> core.ServiceResponse:
+    history = get_delay_history(_get_configured_feed(hass, call))
+    try:
+        statistics = await hass.async_add_executor_job(
+            history.get_statistics,
+            call.data[ATTR_STOP_ID],
+            call.data.get(ATTR_LINES),
+            call.data.get(ATTR_HOUR_OF_WEEK),
+        )
+    except sqlite3.Error as err:
+        raise HomeAssistantError(f"Failed to read delay history: {err}") from err
+    return {"statistics": statistics}
+
+
+async def _async_find_nearest_stops(
+    hass: core.HomeAssistant, call: core.ServiceCall
+) -> core.ServiceResponse:
+    feed = _get_configured_feed(hass, call)
+    await async_load_feed(feed)
+    if not is_database_ready(feed):
+        # The first import takes minutes, so the call does not wait for it
+        start_gtfs_fetch(feed)
+        raise HomeAssistantError(
+            f"Timetable of feed {feed.feed_id} is not imported yet"
+        )
+    # Defaults to the home zone
+    stops = await get_nearest_stops(
+        feed,
+        call.data.get(CONF_LATITUDE, hass.config.latitude),
+        call.data.get(CONF_LONGITUDE, hass.config.longitude),
+        call.data[ATTR_COUNT],
+    )
+    return {"stops": stops}
+
+
+def _format_time(time_str, delay=0):
+    time = to_datetime(time_str, dt_util.now().date())
+    return (time + timedelta(seconds=delay)).strftime("%H:%M")
+
+
+async def _async_get_trip(
+    hass: core.HomeAssistant, call: core.ServiceCall
+) -> core.ServiceResponse:
+    feed = _get_configured_feed(hass, call)
+    trip = await get_trip(feed, call.data[ATTR_TRIP_ID])
+    if trip is None:
+        raise HomeAssistantError(f"Unknown trip {call.data[ATTR_TRIP_ID]}")
+
+    stops = trip.stops
+    if ATTR_STOP_ID in call.data:
+        stop_sequence = next(
+            (
+                stop.stop_sequence
+                for stop in stops
+                if stop.stop_id == call.data[ATTR_STOP_ID]
+            ),
+            None,
+        )
+        if stop_sequence is None:
+            raise HomeAssistantError(
+                f"Trip {trip.trip_id} does not stop at {call.data[ATTR_STOP_ID]}"
+            )
+        stops = [stop for stop in stops if stop.stop_sequence > stop_sequence]
+
+    trip_delays = {}
+    if feed.trip_updates_url is not None:
+        response = await get_cached(feed.trip_updates_url)
+        if response.data is not None:
+            trip_delays = await hass.async_add_executor_job(
+                parse_trip_updates, feed.trip_updates_url, response.data
+            )
+    formatted_stops = []
+    for stop in stops:
+        formatted_stop = {
+            "stop_id": stop.stop_id,
+            "stop_name": stop.stop_name,
+            "stop_sequence": stop.stop_sequence,
+            "arrival": _format_time(stop.arrival_time),
+            "departure": _format_time(stop.departure_time),
+        }
+        delay = get_trip_delay(trip_delays, trip.trip_id, stop.stop_sequence)
+        if delay is not None:
+            formatted_stop["delay"] = delay
+            formatted_stop["expected_arrival"] = _format_time(stop.arrival_time, delay)
+        formatted_stops.append(formatted_stop)
+    return {
+        "trip_id": trip.trip_id,
+        "line": trip.route_id,
+        "destination": trip.trip_headsign,
+        "stops": formatted_stops,
+    }
+
+
+async def _async_get_departures(
+    hass: core.HomeAssistant, call: core.ServiceCall
+) -> core.ServiceResponse:
+    feed = _get_configured_feed(hass, call)
+    lines = call.data.get(ATTR_LINES)
+    args = (
+        feed,
+        call.data[ATTR_STOP_ID],
+        tuple(lines) if lines else None,
+        call.data[ATTR_OFFSET],
+        call.data[ATTR_DURATION],
+        call.data[ATTR_COUNT],
+    )
+    try:
+        departures = await _departure_lookups.run(
+            (feed.feed_id, *args[1:]), _async_lookup_departures, hass, *args
+        )
+    except ValueError as err:
+        raise HomeAssistantError(f"Failed to get departures: {err}") from err
+    return {"departures": departures}
+
+
+async def _async_lookup_departures(
+    hass: core.HomeAssistant, feed, stop_id, lines, offset, duration, count
+):
+    now = dt_util.now()
+    start_time = now + timedelta(minutes=offset)
+    end_time = start_time + timedelta(minutes=duration)
+
+    stop_names = {}
+    await async_load_feed(feed)
+    database_ready = is_database_ready(feed)
+    if not database_ready:
+        # Only realtime departures are served until the timetable is imported
+        start_gtfs_fetch(feed)
+    else:
+        stop_names = {
+            stop["stop_id"]: stop["stop_name"] for stop in await get_stops(feed)
+        }
+        if lines is None:
+            lines = await get_route_ids(feed, stop_id)
+
+    departures = []
+    if feed.stop_url is not None:
+        response = await get_cached(feed.stop_url.format(stop_id))
+        if response.data is not None:
+            departures = parse_departures(
+                json.loads(response.data),
+                stop_id,
+                lambda destination_id: stop_names.get(destination_id, "unknown stop"),
+            )
+    departures = [
+        departure
+        for departure in departures
+        if (lines is None or departure.route_id in lines)
+        and start_time <= get_departure_time(departure) <= end_time
+    ]
+
+    journeys = []
+    if database_ready:
+        # Scheduled departures also tell the trips of realtime departures
+        journeys = await get_stop_times(feed, stop_id, lines, count, start_time)
+        departures, journeys = remove_realtime_journeys(journeys, departures)
+    if len(departures) < count:
+        journeys = await predict_delays(
+            hass,
+            feed,
+            [
+                journey
+                for journey in journeys
+                if start_time <= get_departure_time(journey) <= end_time
+            ],
+            departures,
+            now,
+        )
+    else:
+        journeys = []
+    return [
+        format_departure(item, now)
+        for item in sorted(departures + journeys, key=get_departure_time)[:count]
+    ]
+
+
+def async_setup_services(hass: core.HomeAssistant):
+    """Register the services of the integration."""
+
+    async def async_get_delay_statistics(
+        call: core.ServiceCall,
+    ) -> core.ServiceResponse:
+        return await _async_get_delay_statistics(hass, call)
+
+    async def async_find_nearest_stops(
+        call: core.ServiceCall,
+    ) -> core.ServiceResponse:
+        return await _async_find_nearest_stops(hass, call)
+
+    async def async_get_trip(
+        call: core.ServiceCall,
+    ) -> core.ServiceResponse:
+        return await _async_get_trip(hass, call)
+
+    async def async_get_departures(
+        call: core.ServiceCall,
+    ) -> core.ServiceResponse:
+        return await _async_get_departures(hass, call)
+
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_GET_DELAY_STATISTICS,
+        async_get_delay_statistics,
+        schema=GET_DELAY_STATISTICS_SCHEMA,
+        supports_response=core.SupportsResponse.ONLY,
+    )
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_FIND_NEAREST_STOPS,
+        async_find_nearest_stops,
+        schema=FIND_NEAREST_STOPS_SCHEMA,
+        supports_response=core.SupportsResponse.ONLY,
+    )
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_GET_TRIP,
+        async_get_trip,
+        schema=GET_TRIP_SCHEMA,
+        supports_response=core.SupportsResponse.ONLY,
+    )
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_GET_DEPARTURES,
+        async_get_departures,
+        schema=GET_DEPARTURES_SCHEMA,
+        supports_response=core.SupportsResponse.ONLY,
+    )
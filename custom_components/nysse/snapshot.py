@@ -0,0 +1,57 @@
+"""Persists the latest departures of each sensor over restarts."""
+
+from __future__ import annotations
+
+from typing import Any
+
+from homeassistant import core
+from homeassistant.helpers.storage import Store
+
+from .const import DOMAIN
+
+DATA_SNAPSHOT = f"{DOMAIN}_snapshot"
+STORAGE_KEY = f"{DOMAIN}.departures"
+STORAGE_VERSION = 1
+# Snapshots are written this long after the first change since the last
+# write, and when Home Assistant stops
+SAVE_DELAY = 60
+
+
+class DepartureSnapshot:
+    """Latest departures of the sensors, keyed by unique ID."""
+
+    def __init__(self, hass: core.HomeAssistant) -> None:
+        """Initialize the snapshot."""
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._data: dict[str, dict[str, Any]] = {}
+        self._save_pending = False
+
+    async def async_load(self):
+        """Load the snapshot from storage."""
+        self._data = await self._store.async_load() or {}
+
+    def get(self, key):
+        """Get the stored data of a sensor."""
+        return self._data.get(key)
+
+    @core.callback
+    def async_set(self, key, data):
+        """Store the data of a sensor and schedule a write."""
+        self._data[key] = data
+        # Scheduling again would restart the delay, and sensors update more
+        # often than the delay, so the write would never happen
+        if not self._save_pending:
+            self._save_pending = True
+            self._store.async_delay_save(self._data_to_save, SAVE_DELAY)
+
+    @core.callback
+    def _data_to_save(self):
+        self._save_pending = False
+        return self._data
+
+
+async def async_load_snapshot(hass: core.HomeAssistant):
+    """Load the departure snapshot into hass.data."""
+    snapshot = DepartureSnapshot(hass)
+    await snapshot.async_load()
+    hass.data[DATA_SNAPSHOT] = snapshot
@@ -0,0 +1,247 @@
+"""Compiled timetable for departure lookups without database queries."""
+
+from array import array
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+_LOGGER = logging.getLogger(__name__)
+
+TIMETABLE_FILENAME = "timetable.bin"
+TIMETABLE_VERSION = 2
+
+_MAGIC = b"NYSSETT\0"
+_HEADER_LENGTH = struct.Struct("<I")
+_WEEKDAYS = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+
+
+def _time_to_seconds(time_str):
+    hours, minutes, seconds = map(int, time_str.split(":"))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def _seconds_to_time(value):
+    return f"{value // 3600:02}:{value % 3600 // 60:02}:{value % 60:02}"
+
+
+def write_timetable(file_path, stop_times, trips, calendar):
+    """Write departures of each stop into a compiled timetable file.
+
+    Departures of a stop are stored next to each other, sorted by departure
+    time, in fixed-width arrays of departure seconds and route, headsign and
+    service indices, and trip indices and stop sequences.
+
+    Args:
+        file_path (str): Path of the file to write.
+        stop_times (list): Stop time tuples as parsed from the GTFS files.
+        trips (list): Trip tuples as parsed from the GTFS files.
+        calendar (list): Calendar tuples as parsed from the GTFS files.
+
+    Raises:
+        ValueError: If the timetable cannot be encoded.
+
+    """
+    services = {}
+    service_rows = []
+    for row in calendar:
+        mask = sum(1 << i for i in range(7) if row[i + 1] == "1")
+        services[row[0]] = len(service_rows)
+        service_rows.append((mask, int(row[8]), int(row[9])))
+
+    routes = {}
+    headsigns = {}
+    trip_indices = {}
+    for trip_id, route_id, service_id, trip_headsign, _ in trips:
+        if service_id not in services:
+            continue  # Not in the calendar, so never listed by queries
+        route_index = routes.setdefault(route_id, len(routes))
+        headsign_index = headsigns.setdefault(trip_headsign, len(headsigns))
+        trip_indices[trip_id] = (
+            route_index,
+            headsign_index,
+            services[service_id],
+            len(trip_indices),
+        )
+
+    if max(len(routes), len(headsigns), len(services)) > 0xFFFF:
+        raise ValueError("Too many routes, headsigns or services to compile")
+
+    departures = {}
+    for trip_id, _, departure_time, stop_id, stop_sequence in stop_times:
+        indices = trip_indices.get(trip_id)
+        if indices is None:
+            continue
+        departures.setdefault(stop_id, []).append(
+            (_time_to_seconds(departure_time), *indices, stop_sequence)
+        )
+
+    seconds = array("I")
+    route_column = array("H")
+    headsign_column = array("H")
+    service_column = array("H")
+    trip_column = array("I")
+    sequence_column = array("I")
+    stop_index = {}
+    for stop_id, stop_departures in departures.items():
+        # Ties are in trip order, like the database
+        stop_departures.sort(key=lambda x: (x[0], x[4]))
+        stop_index[stop_id] = (len(seconds), len(stop_departures))
+        for departure in stop_departures:
+            seconds.append(departure[0])
+            route_column.append(departure[1])
+            headsign_column.append(departure[2])
+            service_column.append(departure[3])
+            trip_column.append(departure[4])
+            sequence_column.append(departure[5])
+
+    header = json.dumps(
+        {
+            "version": TIMETABLE_VERSION,
+            "byteorder": sys.byteorder,
+            "count": len(seconds),
+            "routes": list(routes),
+            "headsigns": list(headsigns),
+            "services": service_rows,
+            "trips": list(trip_indices),
+            "stops": stop_index,
+        }
+    ).encode("utf-8")
+    # Pad the header so that the arrays are aligned
+    header += b" " * (-(len(_MAGIC) + _HEADER_LENGTH.size + len(header)) % 4)
+
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_MAGIC)
+        f.write(_HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        # Four byte columns first so that every column stays aligned
+        for column in (
+            seconds,
+            trip_column,
+            sequence_column,
+            route_column,
+            headsign_column,
+            service_column,
+        ):
+            column.tofile(f)
+    os.replace(tmp_path, file_path)
+    _LOGGER.debug("Compiled %s departures to %s", len(seconds), file_path)
+
+
+class Timetable:
+    """Memory-mapped compiled timetable."""
+
+    def __init__(self, file_path) -> None:
+        """Map a compiled timetable file.
+
+        Raises:
+            ValueError: If the file is not a supported compiled timetable.
+
+        """
+        with open(file_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[: len(_MAGIC)] != _MAGIC:
+            raise ValueError("Not a compiled timetable")
+        offset = len(_MAGIC)
+        (header_length,) = _HEADER_LENGTH.unpack_from(self._mmap, offset)
+        offset += _HEADER_LENGTH.size
+        header = json.loads(self._mmap[offset : offset + header_length])
+        offset += header_length
+        if (
+            header["version"] != TIMETABLE_VERSION
+            or header["byteorder"] != sys.byteorder
+        ):
+            raise ValueError("Unsupported compiled timetable")
+
+        self._routes = header["routes"]
+        self._route_indices = {route: i for i, route in enumerate(self._routes)}
+        self._headsigns = header["headsigns"]
+        self._services = header["services"]
+        self._trips = header["trips"]
+        self._stops = header["stops"]
+        self._active_services = {}
+
+        count = header["count"]
+        view = memoryview(self._mmap)
+        self._seconds = view[offset : offset + 4 * count].cast("I")
+        offset += 4 * count
+        self._trip_column = view[offset : offset + 4 * count].cast("I")
+        offset += 4 * count
+        self._sequence_column = view[offset : offset + 4 * count].cast("I")
+        offset += 4 * count
+        self._route_column = view[offset : offset + 2 * count].cast("H")
+        offset += 2 * count
+        self._headsign_column = view[offset : offset + 2 * count].cast("H")
+        offset += 2 * count
+        self._service_column = view[offset : offset + 2 * count].cast("H")
+
+    def _get_active_services(self, date, weekday):
+        if date not in self._active_services:
+            if len(self._active_services) >= len(_WEEKDAYS):
+                self._active_services.clear()
+            bit = 1 << _WEEKDAYS.index(weekday)
+            day = int(date)
+            self._active_services[date] = {
+                i
+                for i, (mask, start_date, end_date) in enumerate(self._services)
+                if mask & bit and start_date <= day <= end_date
+            }
+        return self._active_services[date]
+
+    def get_departures(self, stop_id, route_ids, date, weekday, start_time, amount):
+        """Get departures from a stop on a service day.
+
+        Args:
+            stop_id (str): The ID of the stop.
+            route_ids (list): A list of route IDs.
+            date (str): The service day in %Y%m%d format.
+            weekday (str): Lowercase name of the weekday of the service day.
+            start_time (str): Only departures after this time are returned.
+            amount (int): The maximum number of departures to return.
+
+        Returns:
+            list: Tuples of route ID, trip headsign, departure time, trip ID
+            and stop sequence, in the same format as stored in the database.
+
+        """
+        offset, count = self._stops.get(stop_id, (0, 0))
+        routes = {
+            self._route_indices[route_id]
+            for route_id in route_ids
+            if route_id in self._route_indices
+        }
+        services = self._get_active_services(date, weekday)
+        departures = []
+        start = bisect.bisect_right(
+            self._seconds, _time_to_seconds(start_time), offset, offset + count
+        )
+        for index in range(start, offset + count):
+            if (
+                self._route_column[index] not in routes
+                or self._service_column[index] not in services
+            ):
+                continue
+            departures.append(
+                (
+                    self._routes[self._route_column[index]],
+                    self._headsigns[self._headsign_column[index]],
+                    _seconds_to_time(self._seconds[index]),
+                    self._trips[self._trip_column[index]],
+                    self._sequence_column[index],
+                )
+            )
+            if len(departures) >= amount:
+                break
+        return departures
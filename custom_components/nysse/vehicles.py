@@ -0,0 +1,162 @@
+"""Tracks vehicles approaching configured stops."""
+
+import asyncio
+import json
+import logging
+import math
+from typing import NamedTuple
+
+_LOGGER = logging.getLogger(__name__)
+
+# Vehicles further than this from a stop are not tracked
+TRACKING_RADIUS = 2000
+# Grid cells are at least as large as the tracking radius in both directions
+# at the latitudes of Finland, so only neighbouring cells need to be checked
+CELL_LATITUDE = 0.02
+CELL_LONGITUDE = 0.05
+
+_EARTH_RADIUS = 6371000
+
+
+def get_distance(latitude1, longitude1, latitude2, longitude2):
+    """Get the great-circle distance between two coordinates in meters."""
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    delta_phi = math.radians(latitude2 - latitude1)
+    delta_lambda = math.radians(longitude2 - longitude1)
+    a = (
+        math.sin(delta_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) ** 2
+    )
+    return 2 * _EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def _get_cell(latitude, longitude):
+    return (
+        math.floor(latitude / CELL_LATITUDE),
+        math.floor(longitude / CELL_LONGITUDE),
+    )
+
+
+class Vehicle(NamedTuple):
+    vehicle_id: str
+    route_id: str
+    trip_id: str | None
+    latitude: float
+    longitude: float
+    bearing: float | None
+    speed: float | None
+    current_stop_sequence: int | None
+    distance: int
+
+
+class VehicleTracker:
+    """Finds the nearest vehicles approaching each registered stop.
+
+    Stops are indexed in a grid, so each vehicle in the feed is only compared
+    to the stops in its own and neighbouring cells. The feed is processed once
+    per response and shared by all stops.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the tracker."""
+        self._stops: dict[str, tuple[float, float, set[str]]] = {}
+        self._grid: dict[tuple[int, int], set[str]] = {}
+        self._lock = asyncio.Lock()
+        self._data = None
+        self._candidates: dict[str, list[Vehicle]] = {}
+
+    def register_stop(self, stop_id, latitude, longitude, lines):
+        """Track vehicles of the given lines near a stop."""
+        if stop_id in self._stops:
+            self.unregister_stop(stop_id)
+        self._stops[stop_id] = (latitude, longitude, set(lines))
+        cell_latitude, cell_longitude = _get_cell(latitude, longitude)
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                cell = (cell_latitude + i, cell_longitude + j)
+                self._grid.setdefault(cell, set()).add(stop_id)
+        self._data = None  # Process the feed again for the new stop
+
+    def unregister_stop(self, stop_id):
+        """Stop tracking vehicles near a stop."""
+        if self._stops.pop(stop_id, None) is None:
+            return
+        for cell in list(self._grid):
+            self._grid[cell].discard(stop_id)
+            if len(self._grid[cell]) == 0:
+                del self._grid[cell]
+
+    @staticmethod
+    def _find_candidates(data, stops, grid):
+        lines = set()
+        for stop in stops.values():
+            lines.update(stop[2])
+
+        candidates: dict[str, list[Vehicle]] = {}
+        for entity in json.loads(data).get("entity", []):
+            try:
+                vehicle = entity["vehicle"]
+                route_id = vehicle["trip"]["route_id"]
+                if route_id not in lines:
+                    continue
+                latitude = float(vehicle["position"]["latitude"])
+                longitude = float(vehicle["position"]["longitude"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            for stop_id in grid.get(_get_cell(latitude, longitude), ()):
+                stop_latitude, stop_longitude, stop_lines = stops[stop_id]
+                if route_id not in stop_lines:
+                    continue
+                distance = get_distance(
+                    stop_latitude, stop_longitude, latitude, longitude
+                )
+                if distance > TRACKING_RADIUS:
+                    continue
+                current_stop_sequence = vehicle.get("current_stop_sequence")
+                candidates.setdefault(stop_id, []).append(
+                    Vehicle(
+                        vehicle.get("vehicle", {}).get("id", entity.get("id")),
+                        route_id,
+                        vehicle["trip"].get("trip_id"),
+                        latitude,
+                        longitude,
+                        vehicle["position"].get("bearing"),
+                        vehicle["position"].get("speed"),
+                        int(current_stop_sequence)
+                        if current_stop_sequence is not None
+                        else None,
+                        round(distance),
+                    )
+                )
+        for stop_candidates in candidates.values():
+            stop_candidates.sort(key=lambda vehicle: vehicle.distance)
+        return candidates
+
+    async def async_update(self, hass, data):
+        """Process a vehicle positions response unless already processed.
+
+        Args:
+            hass (HomeAssistant): Home Assistant instance for the executor.
+            data (str): The GTFS-RT vehicle positions response in JSON format.
+
+        """
+        async with self._lock:
+            if data is self._data:
+                return
+            # Stops are registered from the event loop while the feed is
+            # processed in the executor, so the executor gets copies
+            stops = dict(self._stops)
+            grid = {cell: frozenset(stop_ids) for cell, stop_ids in self._grid.items()}
+            try:
+                self._candidates = await hass.async_add_executor_job(
+                    self._find_candidates, data, stops, grid
+                )
+            except ValueError as err:
+                _LOGGER.info("Failed to process vehicle positions: %s", err)
+                self._candidates = {}
+            self._data = data
+
+    def get_candidates(self, stop_id):
+        """Get the vehicles near a stop, nearest first."""
+        return self._candidates.get(stop_id, [])
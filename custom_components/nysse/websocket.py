@@ -0,0 +1,119 @@
+"""Websocket API for subscribing to departures."""
+
+from __future__ import annotations
+
+from typing import Any
+
+import voluptuous as vol
+
+from homeassistant import core
+from homeassistant.components import websocket_api
+import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.dispatcher import (
+    async_dispatcher_connect,
+    async_dispatcher_send,
+)
+
+from .const import CONF_FEED, DEFAULT_FEED, DOMAIN
+from .departures import get_departure_time
+from .fetch_api import StopTime, get_feed
+
+SIGNAL_DEPARTURES = f"{DOMAIN}_departures_updated"
+DATA_DEPARTURES = f"{DOMAIN}_departures"
+
+
+def _to_compact_format(departures: list[StopTime]):
+    # Departure times are absolute, so messages are not sent just because the
+    # remaining time has changed
+    compact = []
+    for departure in sorted(departures, key=get_departure_time):
+        item = {
+            "line": departure.route_id,
+            "destination": departure.trip_headsign,
+            "departure": get_departure_time(departure).isoformat(),
+            "realtime": departure.realtime,
+        }
+        if departure.delay is not None:
+            item["delay"] = departure.delay
+        compact.append(item)
+    return compact
+
+
+@core.callback
+def async_publish_departures(
+    hass: core.HomeAssistant, feed_id, stop_id, departures: list[StopTime]
+):
+    """Send the departures of a stop to subscribers if they have changed.
+
+    Args:
+        hass (HomeAssistant): Home Assistant instance.
+        feed_id (str): The ID of the feed the stop belongs to.
+        stop_id (str): The ID of the stop.
+        departures (list): Departures as StopTime tuples.
+
+    """
+    departures = _to_compact_format(departures)
+    latest = hass.data.setdefault(DATA_DEPARTURES, {})
+    if latest.get((feed_id, stop_id)) == departures:
+        return
+    latest[(feed_id, stop_id)] = departures
+    async_dispatcher_send(hass, SIGNAL_DEPARTURES, feed_id, stop_id, departures)
+
+
+@websocket_api.websocket_command(
+    {
+        vol.Required("type"): f"{DOMAIN}/subscribe_departures",
+        vol.Optional(CONF_FEED, default=DEFAULT_FEED): cv.string,
+        vol.Required("stops"): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional("lines"): vol.All(cv.ensure_list, [cv.string]),
+    }
+)
+@core.callback
+def websocket_subscribe_departures(
+    hass: core.HomeAssistant,
+    connection: websocket_api.ActiveConnection,
+    msg: dict[str, Any],
+) -> None:
+    """Subscribe to departures of stops followed by sensors.
+
+    An event with the departures of a stop is sent when the subscription
+    starts and whenever they change, limited to the given lines.
+    """
+    feed_id = get_feed(msg[CONF_FEED]).feed_id
+    stops = set(msg["stops"])
+    lines = set(msg["lines"]) if "lines" in msg else None
+    sent: dict[str, list[dict[str, Any]]] = {}
+
+    @core.callback
+    def forward_departures(departures_feed_id, stop_id, departures):
+        if departures_feed_id != feed_id or stop_id not in stops:
+            return
+        compact = [
+            departure
+            for departure in departures
+            if lines is None or departure["line"] in lines
+        ]
+        if sent.get(stop_id) == compact:
+            return  # Only other lines have changed
+        sent[stop_id] = compact
+        connection.send_message(
+            websocket_api.event_message(
+                msg["id"], {"stop_id": stop_id, "departures": compact}
+            )
+        )
+
+    connection.subscriptions[msg["id"]] = async_dispatcher_connect(
+        hass, SIGNAL_DEPARTURES, forward_departures
+    )
+    connection.send_result(msg["id"])
+
+    latest = hass.data.get(DATA_DEPARTURES, {})
+    for stop_id in stops:
+        if (feed_id, stop_id) in latest:
+            forward_departures(feed_id, stop_id, latest[(feed_id, stop_id)])
+
+
+@core.callback
+def async_setup_websocket_api(hass: core.HomeAssistant):
+    """Register the websocket commands of the integration."""
+    websocket_api.async_register_command(hass, websocket_subscribe_departures)
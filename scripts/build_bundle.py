@@ -0,0 +1,29 @@
+"""Build a prebuilt timetable bundle for the Nysse integration.
+
+Runs without Home Assistant, for example on a desktop computer:
+
+    python scripts/build_bundle.py https://example.com/gtfs.zip -o bundle.zip
+
+The bundle can then be served to Home Assistant from a local path or URL.
+"""
+
+import importlib
+import importlib.machinery
+import importlib.util
+import pathlib
+import sys
+
+PACKAGE_PATH = pathlib.Path(__file__).resolve().parent.parent / (
+    "custom_components/nysse"
+)
+
+# The integration package imports Home Assistant on import, so its modules are
+# loaded under a bare package without running its __init__.py. This runs in
+# parsing processes too, which import this script before receiving work.
+_spec = importlib.machinery.ModuleSpec("nysse", None, is_package=True)
+_package = importlib.util.module_from_spec(_spec)
+_package.__path__ = [str(PACKAGE_PATH)]
+sys.modules.setdefault("nysse", _package)
+
+if __name__ == "__main__":
+    sys.exit(importlib.import_module("nysse.bundle").main())